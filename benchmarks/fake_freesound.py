@@ -0,0 +1,260 @@
+import argparse
+import gzip
+import hashlib
+import json
+import random
+import re
+import sys
+import threading
+import time
+from datetime import datetime, timedelta, timezone
+from functools import lru_cache
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from pathlib import Path
+from urllib.parse import parse_qs, urlencode, urlparse
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+
+import synthetic  # noqa: E402
+
+
+# A local stand-in for the parts of the Freesound API used by the
+# scripts. The corpus of sounds is synthetic and faults can be injected
+# to test how the clients cope with latency, errors, and truncation.
+# To use it, set FREESOUND_API_BASE to http://HOST:PORT/apiv2.
+
+
+class FakeFreesound(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, address, n_sounds=10000, seed=1000, latency=0,
+                 rate_limit_rate=0, error_rate=0, truncate_rate=0,
+                 token_lifetime=None):
+        super().__init__(address, Handler)
+        self.latency = latency
+        self.rate_limit_rate = rate_limit_rate
+        self.error_rate = error_rate
+        self.truncate_rate = truncate_rate
+        self.token_lifetime = token_lifetime
+        self.rng = random.Random(seed)
+        self.lock = threading.Lock()
+        self.n_requests = 0
+
+        # Sounds are created one minute apart in order of their ids
+        labels = synthetic.load_label_set()
+        rng = random.Random(seed)
+        start = datetime(2005, 4, 1, tzinfo=timezone.utc)
+        self.sounds = {}
+        for clip_id in range(1, n_sounds + 1):
+            sound = synthetic._sound(clip_id, labels, rng)
+            created = start + timedelta(minutes=clip_id)
+            sound['created'] = created.strftime('%Y-%m-%dT%H:%M:%S.%f')
+            self.sounds[clip_id] = sound
+
+    @property
+    def base_url(self):
+        host, port = self.server_address[:2]
+        return f'http://{host}:{port}/apiv2'
+
+    def handle_error(self, request, client_address):
+        # Clients close connections abruptly after truncated responses
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+    def fault(self):
+        # Decide which fault (if any) to inject into a response
+        with self.lock:
+            self.n_requests += 1
+            if self.token_lifetime is not None \
+                    and self.n_requests > self.token_lifetime:
+                return 401
+            value = self.rng.random()
+        if value < self.rate_limit_rate:
+            return 429
+        if value < self.rate_limit_rate + self.error_rate:
+            return 500
+        if value < self.rate_limit_rate + self.error_rate \
+                + self.truncate_rate:
+            return 'truncate'
+        return None
+
+
+class Handler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urlparse(self.path)
+        params = {k: v[-1] for k, v in parse_qs(url.query).items()}
+
+        if self.server.latency > 0:
+            time.sleep(self.server.rng.uniform(0, 2 * self.server.latency))
+
+        if not self.headers.get('Authorization'):
+            return self.send_json(401, {'detail': 'Authentication required'})
+
+        fault = self.server.fault()
+        if fault == 401:
+            return self.send_json(401, {'detail': 'Invalid token'})
+        if fault == 429:
+            return self.send_json(429, {'detail': 'Request was throttled'},
+                                  {'Retry-After': '1'})
+        if fault == 500:
+            return self.send_json(500, {'detail': 'Server error'})
+
+        truncate = fault == 'truncate'
+        match = re.fullmatch(r'/apiv2/sounds/(\d+)/(download/)?', url.path)
+        if url.path == '/apiv2/search/text/':
+            self.search(params, truncate)
+        elif match and int(match.group(1)) in self.server.sounds:
+            sound = self.server.sounds[int(match.group(1))]
+            if match.group(2):
+                self.download(sound, truncate)
+            else:
+                self.send_json(200, select_fields(sound, params),
+                               truncate=truncate)
+        else:
+            self.send_json(404, {'detail': 'Not found'})
+
+    def search(self, params, truncate):
+        sounds = filter_sounds(self.server.sounds.values(),
+                               params.get('filter', ''))
+        if params.get('sort', 'created_asc') == 'created_desc':
+            sounds = sounds[::-1]
+
+        page = int(params.get('page', 1))
+        page_size = int(params.get('page_size', 15))
+        n_pages = max(1, -(-len(sounds) // page_size))
+        if page < 1 or page > n_pages:
+            return self.send_json(404, {'detail': 'Invalid page.'})
+
+        def _page_url(number):
+            query = urlencode({**params, 'page': number})
+            return f'{self.server.base_url}/search/text/?{query}'
+
+        results = sounds[(page - 1) * page_size:page * page_size]
+        self.send_json(200, {
+            'count': len(sounds),
+            'next': _page_url(page + 1) if page < n_pages else None,
+            'results': [select_fields(sound, params) for sound in results],
+            'previous': _page_url(page - 1) if page > 1 else None,
+        }, truncate=truncate)
+
+    def download(self, sound, truncate):
+        body = audio_data(sound['duration'])
+        start = 0
+        range_match = re.fullmatch(r'bytes=(\d+)-',
+                                   self.headers.get('Range', ''))
+        if range_match:
+            start = int(range_match.group(1))
+            if start >= len(body):
+                return self.send_json(416, {'detail': 'Invalid range'}, {
+                    'Content-Range': f'bytes */{len(body)}'})
+
+        status = 206 if start > 0 else 200
+        headers = {'Content-Type': 'audio/wav'}
+        if start > 0:
+            headers['Content-Range'] = \
+                f'bytes {start}-{len(body) - 1}/{len(body)}'
+        self.send_body(status, body[start:], headers, truncate)
+
+    def send_json(self, status, obj, headers=None, truncate=False):
+        body = json.dumps(obj).encode()
+        headers = {'Content-Type': 'application/json', **(headers or {})}
+        if status == 200:
+            # Allow clients to revalidate cached responses
+            etag = '"' + hashlib.md5(body).hexdigest() + '"'
+            headers['ETag'] = etag
+            if self.headers.get('If-None-Match') == etag:
+                return self.send_body(304, b'', headers)
+        if 'gzip' in self.headers.get('Accept-Encoding', ''):
+            body = gzip.compress(body)
+            headers['Content-Encoding'] = 'gzip'
+        self.send_body(status, body, headers, truncate)
+
+    def send_body(self, status, body, headers, truncate=False):
+        self.send_response(status)
+        for name, value in headers.items():
+            self.send_header(name, value)
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+
+        # A truncated response promises the full body but closes the
+        # connection halfway through it
+        if truncate:
+            self.wfile.write(body[:len(body) // 2])
+            self.close_connection = True
+        else:
+            self.wfile.write(body)
+
+
+def filter_sounds(sounds, filter_):
+    # Only range filters (e.g. duration:[* TO 30]) are supported
+    sounds = list(sounds)
+    for field, low, high in re.findall(r'(\w+):\[(\S+) TO (\S+)\]', filter_):
+        def _convert(value):
+            return value if field == 'created' else float(value)
+
+        def _in_range(sound):
+            value = _convert(sound[field])
+            return (low == '*' or value >= _convert(low.rstrip('Z'))) \
+                and (high == '*' or value <= _convert(high.rstrip('Z')))
+
+        sounds = list(filter(_in_range, sounds))
+    return sounds
+
+
+def select_fields(sound, params):
+    fields = params.get('fields')
+    if not fields:
+        return sound
+    return {field: sound[field] for field in fields.split(',')
+            if field in sound}
+
+
+@lru_cache(maxsize=64)
+def audio_data(duration):
+    # Clips are capped at two seconds to keep the responses small
+    return synthetic.wav_bytes(min(duration, 2))
+
+
+def main(args):
+    server = FakeFreesound((args.host, args.port), args.n_sounds, args.seed,
+                           args.latency, args.rate_limit_rate,
+                           args.error_rate, args.truncate_rate,
+                           args.token_lifetime)
+    print(f'Serving {args.n_sounds} sounds at {server.base_url}')
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        server.server_close()
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--host', default='127.0.0.1',
+                        help='address to listen on')
+    parser.add_argument('--port', type=int, default=8000,
+                        help='port to listen on')
+    parser.add_argument('--n_sounds', type=int, default=10000,
+                        help='number of sounds in the synthetic corpus')
+    parser.add_argument('--seed', type=int, default=1000,
+                        help='seed for generating the corpus and faults')
+    parser.add_argument('--latency', type=float, default=0,
+                        help='mean latency of each response in seconds')
+    parser.add_argument('--rate_limit_rate', type=float, default=0,
+                        help='fraction of requests answered with 429')
+    parser.add_argument('--error_rate', type=float, default=0,
+                        help='fraction of requests answered with 500')
+    parser.add_argument('--truncate_rate', type=float, default=0,
+                        help='fraction of responses that are truncated')
+    parser.add_argument('--token_lifetime', type=int,
+                        help='number of requests after which every '
+                             'request is answered with 401')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
@@ -0,0 +1,224 @@
+import argparse
+import json
+import os
+import platform
+import subprocess
+import sys
+import time
+import tracemalloc
+from datetime import datetime, timezone
+from pathlib import Path
+from types import SimpleNamespace
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+sys.path.insert(0, str(ROOT_DIR / 'src'))
+sys.path.insert(0, str(ROOT_DIR / 'benchmarks'))
+
+import synthetic  # noqa: E402
+
+
+BENCHMARKS = {}
+
+
+class MissingDependency(Exception):
+    pass
+
+
+def benchmark(name):
+    # A benchmark function prepares its inputs and returns a function
+    # that runs the code being measured
+    def _register(setup):
+        BENCHMARKS[name] = setup
+        return setup
+    return _register
+
+
+@benchmark('load_freesound_metadata')
+def bench_load_metadata(data_dir):
+    import utils
+
+    return lambda: utils.load_freesound_metadata(data_dir / 'query')
+
+
+@benchmark('load_freesound_metadata_cached')
+def bench_load_metadata_cached(data_dir):
+    import utils
+
+    cache_path = data_dir / 'query.pkl'
+    utils.load_freesound_metadata(data_dir / 'query', cache_path)
+    return lambda: utils.load_freesound_metadata(data_dir / 'query',
+                                                 cache_path)
+
+
+@benchmark('Vocabulary.__init__')
+def bench_vocabulary(data_dir):
+    lemmatizer, ontology, label_set = _vocabulary_inputs(data_dir)
+
+    import retrieval
+
+    return lambda: retrieval.Vocabulary(label_set, ontology, lemmatizer)
+
+
+@benchmark('retrieval.retrieve')
+def bench_retrieve(data_dir):
+    lemmatizer, ontology, label_set = _vocabulary_inputs(data_dir)
+
+    import retrieval
+    import utils
+
+    vocab = retrieval.Vocabulary(label_set, ontology, lemmatizer)
+    entries = utils.load_freesound_metadata(data_dir / 'query')
+    return lambda: retrieval.retrieve(entries, vocab, lemmatizer,
+                                      batch_size=4096)
+
+
+@benchmark('to_single_label')
+def bench_to_single_label(data_dir):
+    from jaffadata.datasets import FSD50K
+
+    from create_fsd50k_subset import to_single_label
+    from ontology import OntologyIndex
+
+    dataset = FSD50K(data_dir / 'fsd50k')
+    ontology = OntologyIndex.load(ROOT_DIR / 'metadata/ontology.json')
+    return lambda: to_single_label(dataset['training'], ontology)
+
+
+@benchmark('curate_datasets.curate')
+def bench_curate(data_dir):
+    from curate_datasets import curate
+
+    def _run():
+        # Remove the inventory so that every WAV file is validated
+        (data_dir / 'inventory.csv').unlink(missing_ok=True)
+        curate(SimpleNamespace(work_dir=data_dir))
+    return _run
+
+
+def _vocabulary_inputs(data_dir):
+    import nltk
+    from nltk.stem import WordNetLemmatizer
+    from nltk.tokenize import punkt
+
+    import synthetic
+    from ontology import OntologyIndex
+
+    # NLTK 3.8.2 and later load the Punkt parameters from punkt_tab
+    # instead of a pickle
+    if hasattr(punkt, 'PunktTokenizer'):
+        punkt_resource = 'tokenizers/punkt_tab/english/'
+    else:
+        punkt_resource = 'tokenizers/punkt/english.pickle'
+
+    # Ensure the required NLTK resources are available offline
+    # This must be done before importing the retrieval package
+    for resource in ['corpora/stopwords', punkt_resource, 'corpora/wordnet']:
+        try:
+            nltk.data.find(resource)
+        except LookupError:
+            raise MissingDependency(f'NLTK resource {resource} not found')
+
+    from retrieval import ShortestLemmatizer
+
+    lemmatizer = ShortestLemmatizer(WordNetLemmatizer())
+    ontology = OntologyIndex.load(ROOT_DIR / 'metadata/ontology.json')
+    label_set = sorted(label for label, _ in synthetic.load_label_set())
+    return lemmatizer, ontology, label_set
+
+
+def run_benchmark(setup, data_dir, repeat):
+    fn = setup(data_dir)
+
+    # Measure the time first, as tracing memory allocations adds
+    # significant overhead
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        fn()
+        times.append(time.perf_counter() - start)
+
+    tracemalloc.start()
+    fn()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    return {'seconds': min(times), 'mean_seconds': sum(times) / len(times),
+            'peak_memory_bytes': peak}
+
+
+def git_commit():
+    try:
+        return subprocess.run(['git', 'rev-parse', 'HEAD'], cwd=ROOT_DIR,
+                              capture_output=True, text=True,
+                              check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+def main(args):
+    names = args.benchmarks or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        raise ValueError(f'Unknown benchmarks: {", ".join(sorted(unknown))}')
+
+    # The scripts expect to be run from the root directory
+    data_dir = args.data_dir.resolve() / f'n{args.scale}_seed{args.seed}'
+    output_path = args.output.resolve()
+    os.chdir(ROOT_DIR)
+
+    # Generate the fixtures unless they exist already
+    if not (data_dir / 'labels.txt').exists():
+        print(f'Generating fixtures in {data_dir}')
+        synthetic.generate(data_dir, args.scale, args.seed)
+
+    results = []
+    for name in names:
+        print(f'Running {name}')
+        try:
+            result = run_benchmark(BENCHMARKS[name], data_dir, args.repeat)
+        except (ImportError, MissingDependency) as e:
+            # Skip benchmarks whose dependencies are unavailable
+            print(f'  Skipped: {e}')
+            results.append({'name': name, 'error': str(e)})
+            continue
+
+        results.append({'name': name, **result})
+        print(f'  {result["seconds"]:.3f} s, '
+              f'{result["peak_memory_bytes"] / 2 ** 20:.1f} MiB')
+
+    report = {
+        'commit': git_commit(),
+        'timestamp': datetime.now(timezone.utc).isoformat(),
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'scale': args.scale,
+        'seed': args.seed,
+        'repeat': args.repeat,
+        'results': results,
+    }
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    with open(output_path, 'w') as f:
+        json.dump(report, f, indent=2)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('benchmarks', nargs='*',
+                        help='names of the benchmarks to run (default: all)')
+    parser.add_argument('--scale', type=int, default=10000,
+                        help='number of synthetic clips')
+    parser.add_argument('--seed', type=int, default=1000,
+                        help='seed for generating the fixtures')
+    parser.add_argument('--repeat', type=int, default=3,
+                        help='number of timed runs per benchmark')
+    parser.add_argument('--data_dir', type=Path,
+                        default=Path('_benchmarks'),
+                        help='path to directory for the fixtures')
+    parser.add_argument('--output', type=Path,
+                        default=Path('_benchmarks/results.json'),
+                        help='path to the output JSON file')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
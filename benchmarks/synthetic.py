@@ -0,0 +1,172 @@
+import json
+import os
+import random
+import shutil
+import struct
+
+import numpy as np
+import pandas as pd
+
+
+PAGE_SIZE = 150
+
+FILLER_WORDS = [
+    'recorded', 'with', 'a', 'microphone', 'in', 'the', 'studio', 'field',
+    'recording', 'of', 'sound', 'loud', 'quiet', 'close', 'distant', 'room',
+    'outside', 'night', 'morning', 'short', 'long', 'take', 'zoom', 'stereo',
+    'processed', 'raw', 'sample', 'noise', 'ambience', 'effect', 'my',
+]
+
+LICENSE = 'http://creativecommons.org/licenses/by/3.0/'
+
+
+def generate(output_dir, n_clips, seed=1000):
+    # Generate all fixtures for a work directory of the given scale
+    labels = load_label_set()
+    rng = random.Random(seed)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    generate_query_pages(output_dir / 'query', labels, n_clips, rng)
+    generate_fsd50k(output_dir / 'fsd50k', labels, n_clips, rng)
+    generate_curation_inputs(output_dir, labels, n_clips, rng)
+
+
+def load_label_set():
+    mids = pd.read_csv('metadata/fsd50k_mids.csv', index_col=0)
+    return list(mids.itertuples(name=None))
+
+
+def generate_query_pages(output_dir, labels, n_clips, rng):
+    output_dir.mkdir(parents=True, exist_ok=True)
+    n_pages = -(-n_clips // PAGE_SIZE)
+    for page in range(1, n_pages + 1):
+        start = (page - 1) * PAGE_SIZE
+        ids = range(start + 1, min(start + PAGE_SIZE, n_clips) + 1)
+        results = [_sound(clip_id, labels, rng) for clip_id in ids]
+        json_dict = {
+            'count': n_clips,
+            'next': None if page == n_pages else f'page={page + 1}',
+            'previous': None if page == 1 else f'page={page - 1}',
+            'results': results,
+        }
+        with open(output_dir / f'page{page:04d}.json', 'w') as f:
+            json.dump(json_dict, f, indent=2)
+
+
+def _sound(clip_id, labels, rng):
+    label = rng.choice(labels)[0]
+    words = label.lower().split('_')
+    tags = rng.sample(words + FILLER_WORDS, rng.randint(0, 6))
+    desc_words = [rng.choice(words + FILLER_WORDS)
+                  for _ in range(rng.randint(0, 40))]
+    return {
+        'id': clip_id,
+        'name': f'{label}_{clip_id}.wav',
+        'tags': tags,
+        'description': ' '.join(desc_words).capitalize() + '.',
+        'type': 'wav',
+        'channels': rng.choice([1, 2]),
+        'bitdepth': 16,
+        'duration': round(rng.uniform(0.1, 35), 3),
+        'samplerate': 44100,
+        'license': LICENSE,
+        'username': f'user{rng.randrange(1000)}',
+    }
+
+
+def generate_fsd50k(dataset_dir, labels, n_clips, rng):
+    gt_dir = dataset_dir / 'FSD50K.ground_truth'
+    gt_dir.mkdir(parents=True, exist_ok=True)
+    (dataset_dir / 'FSD50K.dev_audio').mkdir(exist_ok=True)
+    (dataset_dir / 'FSD50K.eval_audio').mkdir(exist_ok=True)
+
+    # Most clips are single-label, but some have a second label
+    def _annotations(fname):
+        chosen = [rng.choice(labels)]
+        if rng.random() < 0.3:
+            chosen.append(rng.choice(labels))
+        return fname, ','.join(label for label, _ in chosen), \
+            ','.join(mid for _, mid in chosen)
+
+    n_eval = n_clips // 5
+    dev = [_annotations(i) for i in range(n_clips - n_eval)]
+    dev = pd.DataFrame(dev, columns=['fname', 'labels', 'mids'])
+    dev['split'] = [rng.choice(['train'] * 7 + ['val']) for _ in dev.index]
+    dev.to_csv(gt_dir / 'dev.csv', index=False)
+    eval_ = [_annotations(i) for i in range(n_clips, n_clips + n_eval)]
+    eval_ = pd.DataFrame(eval_, columns=['fname', 'labels', 'mids'])
+    eval_.to_csv(gt_dir / 'eval.csv', index=False)
+
+    vocab = pd.DataFrame(labels, columns=['label', 'mid'])
+    vocab.to_csv(gt_dir / 'vocabulary.csv', header=False)
+
+
+def generate_curation_inputs(work_dir, labels, n_clips, rng):
+    # Use a subset of the labels as the final label set
+    label_set = sorted(label for label, _ in labels[::4])
+    with open(work_dir / 'labels.txt', 'w') as f:
+        f.write('\n'.join(label_set))
+
+    # Create the FSD50K subset annotations
+    subset_dir = work_dir / 'subset'
+    subset_dir.mkdir(exist_ok=True)
+    mids = dict(labels)
+    n_subset = max(len(label_set), n_clips // 10)
+    for split, fraction in [('train', 0.6), ('val', 0.2), ('test', 0.2)]:
+        chosen = label_set + [rng.choice(label_set)
+                              for _ in range(int(n_subset * fraction))]
+        df = pd.DataFrame({'label': chosen,
+                           'mid': [mids[label] for label in chosen]})
+        df.index = pd.Index(range(len(df)), name='fname') + \
+            (0 if split == 'train' else 10 ** 7)
+        df.to_csv(subset_dir / f'{split}.csv')
+
+    # Create the download list with enough clips per class to sample
+    # the same number of clips as the training set
+    train = pd.read_csv(subset_dir / 'train.csv', index_col=0)
+    sizes = train.groupby('label').size()
+    predictions = [label for label, size in sizes.items()
+                   for _ in range(2 * size)]
+    predictions += [rng.choice(label_set)
+                    for _ in range(max(0, n_clips - len(predictions)))]
+    downloads = pd.DataFrame({'prediction': predictions},
+                             index=pd.Index(range(1, len(predictions) + 1)))
+    downloads.to_csv(work_dir / 'download_list.csv')
+
+    # Create the audio files, most of which are valid
+    # Files with the same duration are hard links to the same file
+    audio_dir = work_dir / 'audio'
+    audio_dir.mkdir(exist_ok=True)
+    templates_dir = work_dir / 'templates'
+    templates_dir.mkdir(exist_ok=True)
+    durations = [0.1, 0.5, 1.0, 2.5, 5.0]
+    for duration in durations:
+        write_wav(templates_dir / f'{duration}.wav', duration)
+    for clip_id in downloads.index:
+        if rng.random() < 0.02:
+            continue
+        template = templates_dir / f'{rng.choice(durations)}.wav'
+        _link(template, audio_dir / f'{clip_id}.wav')
+
+
+def write_wav(path, duration, sample_rate=44100):
+    with open(path, 'wb') as f:
+        f.write(wav_bytes(duration, sample_rate))
+
+
+def wav_bytes(duration, sample_rate=44100):
+    n_frames = int(duration * sample_rate)
+    rng = np.random.default_rng(n_frames)
+    data = rng.integers(-2 ** 15, 2 ** 15, n_frames, dtype=np.int16)
+    header = struct.pack('<4sI4s4sIHHIIHH4sI', b'RIFF', 36 + data.nbytes,
+                         b'WAVE', b'fmt ', 16, 1, 1, sample_rate,
+                         sample_rate * 2, 2, 16, b'data', data.nbytes)
+    return header + data.astype('<i2').tobytes()
+
+
+def _link(src, dst):
+    if dst.exists():
+        return
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copyfile(src, dst)
@@ -0,0 +1,89 @@
+import os
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from wavfile import WavError, read_info
+
+
+# An archive stores the samples of many mono 16-bit clips in a single
+# file (PATH.pcm), one clip after another, and an index (PATH.csv) that
+# gives the offset and length (in samples) of each clip by file name.
+
+
+class AudioArchive:
+    def __init__(self, path):
+        self.index = pd.read_csv(f'{path}.csv', index_col=0)
+        self._offsets = dict(zip(self.index.index, self.index.offset))
+        self._lengths = dict(zip(self.index.index, self.index.length))
+
+        # The samples are memory-mapped, so only the clips that are
+        # accessed are read from disk
+        if os.path.getsize(f'{path}.pcm') > 0:
+            self.data = np.memmap(f'{path}.pcm', dtype='<i2', mode='r')
+        else:
+            self.data = np.zeros(0, dtype='<i2')
+
+    def __getitem__(self, fname):
+        # Return a view of the clip's samples without copying them
+        offset = self._offsets[fname]
+        return self.data[offset:offset + self._lengths[fname]]
+
+    def __contains__(self, fname):
+        return fname in self._offsets
+
+    def __iter__(self):
+        return iter(self.index.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def write_archive(clips, path, n_workers=8):
+    # Clips are read concurrently but written in order. The number of
+    # clips read ahead is bounded so that memory usage is too.
+    clips = list(clips)
+    fnames = [fname for fname, _ in clips]
+    lengths = []
+    sample_rates = []
+    tmp_path = f'{path}.pcm.part'
+    with open(tmp_path, 'wb') as f, ThreadPoolExecutor(n_workers) as executor:
+        pending = deque()
+        jobs = iter(clips)
+        while True:
+            for _, wav_path in jobs:
+                pending.append(executor.submit(read_samples, wav_path))
+                if len(pending) >= 4 * n_workers:
+                    break
+            if not pending:
+                break
+
+            sample_rate, samples = pending.popleft().result()
+            f.write(samples)
+            lengths.append(len(samples) // 2)
+            sample_rates.append(sample_rate)
+
+    lengths = np.array(lengths, dtype=np.int64)
+    index = pd.DataFrame({
+        'offset': np.cumsum(lengths) - lengths,
+        'length': lengths,
+        'sample_rate': sample_rates,
+    }, index=pd.Index(fnames, name='fname'))
+    index.to_csv(f'{path}.csv.part')
+
+    # The index is replaced last, as it is what readers open first
+    os.replace(tmp_path, f'{path}.pcm')
+    os.replace(f'{path}.csv.part', f'{path}.csv')
+    return index
+
+
+def read_samples(path):
+    info = read_info(path)
+    if info.channels != 1 or info.bit_depth != 16:
+        raise WavError(f'{path} is not a mono 16-bit WAV file')
+
+    with open(path, 'rb') as f:
+        f.seek(info.data_offset)
+        return info.sample_rate, f.read(info.n_frames * 2)
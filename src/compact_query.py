@@ -0,0 +1,73 @@
+import argparse
+import gzip
+import json
+import os
+import re
+import sys
+from pathlib import Path
+
+import utils
+
+
+def compact(args):
+    query_dir = args.work_dir / 'query'
+    segments = compact_pages(query_dir, args.pages_per_segment)
+    for path in segments:
+        print(f'Wrote {path.name}')
+    print(f'Compacted query results into {len(segments)} segments')
+
+
+def compact_pages(query_dir, pages_per_segment=100):
+    # Pages that have not been compacted yet, in order of page number
+    # The last page is left as is, as it is downloaded again when the
+    # query is resumed (see query_freesound.py)
+    paths = [path for path in utils.page_paths(query_dir)
+             if utils.page_count(path) == 1
+             and not path.name.endswith('.ndjson.gz')][:-1]
+
+    segments = []
+    for i in range(0, len(paths), pages_per_segment):
+        group = paths[i:i + pages_per_segment]
+        first, last = _page_number(group[0]), _page_number(group[-1])
+        if last - first + 1 != len(group):
+            raise ValueError(f'Pages {first}-{last} are not contiguous')
+
+        entries = (entry for path in group
+                   for entry in utils.read_results(path))
+        output_path = query_dir / f'page{first:04d}-{last:04d}.ndjson.gz'
+        write_segment(output_path, entries)
+        segments.append(output_path)
+
+        # Remove the pages only once they have been written to a segment
+        for path in group:
+            path.unlink()
+
+    return segments
+
+
+def write_segment(path, entries, fields=utils.QUERY_FIELDS):
+    # Each line is one sound with only the fields that were requested
+    tmp_path = path.with_name(path.name + '.part')
+    with gzip.open(tmp_path, 'wt', compresslevel=6) as f:
+        for entry in entries:
+            record = {field: entry[field] for field in fields
+                      if field in entry}
+            f.write(json.dumps(record, separators=(',', ':')) + '\n')
+    os.replace(tmp_path, path)
+
+
+def _page_number(path):
+    return int(re.match(r'page(\d+)', path.name).group(1))
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=Path, default=Path('_output'),
+                        help='path to workspace directory')
+    parser.add_argument('--pages_per_segment', type=int, default=100,
+                        help='number of pages to store in each segment')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(compact(parse_args()))
@@ -1,27 +1,106 @@
 import argparse
+import os
 import subprocess
 import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
+from metrics import METRICS, write_report
+
 
 def convert(args):
+    import pandas as pd
+    from tqdm import tqdm
+
+    import utils
+    from inventory import update_inventory
+
+    shard = utils.parse_shard(args.shard) if args.shard else None
+
     # Ensure output directory exists
     output_dir = args.work_dir / 'audio'
     output_dir.mkdir(parents=True, exist_ok=True)
 
-    downloads_dir = args.work_dir / 'downloads'
-    for path in downloads_dir.iterdir():
-        output_path = output_dir / (path.stem + '.wav')
-        if not output_path.exists():
-            cmd = f'ffmpeg -i {path} -sample_fmt s16 -ar 44100 ' \
-                  f'-ac 1 -acodec pcm_s16le {output_path}'
-            subprocess.run(cmd.split())
+    # Determine which downloaded clips have not been converted yet
+    inventory = update_inventory(args.work_dir, shard=shard)
+    mask = inventory.download_path.notna() & inventory.audio_path.isna()
+    jobs = [(args.work_dir / path, output_dir / f'{clip_id}.wav')
+            for clip_id, path in inventory.download_path[mask].items()]
+
+    # Run multiple ffmpeg processes at once
+    # Each thread waits on its own ffmpeg process
+    with ThreadPoolExecutor(args.workers) as executor:
+        errors = list(tqdm(executor.map(_convert, jobs), total=len(jobs)))
+
+    # Record the converted files in the inventory
+    update_inventory(args.work_dir, shard=shard)
+
+    # Write a report of the files that could not be converted
+    errors = [(path.name, error) for (path, _), error in zip(jobs, errors)
+              if error is not None]
+    report = pd.DataFrame(errors, columns=['fname', 'error'])
+    report_path = args.work_dir / 'conversion_errors.csv'
+    if shard is not None:
+        report_path = utils.shard_path(args.work_dir, report_path.name, shard)
+    report.to_csv(report_path, index=False)
+    if len(errors) > 0:
+        print(f'Unable to convert {len(errors)} of {len(jobs)} files '
+              f'(see {report_path.name})')
+
+    METRICS.inc('convert.files', len(jobs) - len(errors))
+    METRICS.inc('convert.failures', len(errors))
+    stage = 'convert_audio'
+    if shard is not None:
+        stage += f'.{utils.shard_name(shard)}'
+    write_report(args.work_dir, stage, args.metrics_textfile)
+
+
+def _convert(job):
+    path, output_path = job
+    try:
+        convert_file(path, output_path)
+    except subprocess.CalledProcessError as e:
+        # Only keep the last line of ffmpeg's output
+        lines = e.stderr.decode(errors='replace').strip().split('\n')
+        return lines[-1] or f'ffmpeg exited with code {e.returncode}'
+    except OSError as e:
+        return str(e)
+
+
+def convert_file(path, output_path):
+    # Write to a temporary file first so that an interrupted conversion
+    # does not leave a partial WAV file at the output path
+    tmp_path = output_path.with_name(output_path.name + '.part')
+    cmd = ['ffmpeg', '-y', '-nostdin', '-loglevel', 'error', '-i', str(path),
+           '-sample_fmt', 's16', '-ar', '44100', '-ac', '1',
+           '-acodec', 'pcm_s16le', '-f', 'wav', str(tmp_path)]
+    start = time.perf_counter()
+    try:
+        subprocess.run(cmd, check=True, stdout=subprocess.DEVNULL,
+                       stderr=subprocess.PIPE)
+    except BaseException:
+        tmp_path.unlink(missing_ok=True)
+        raise
+    finally:
+        METRICS.add_time('convert.ffmpeg', time.perf_counter() - start)
+
+    os.replace(tmp_path, output_path)
 
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--work_dir', type=Path, default=Path('_output'),
                         help='path to workspace directory')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of ffmpeg processes to run at once')
+    parser.add_argument('--shard', metavar='INDEX/COUNT',
+                        help='only convert the clips of the given shard, '
+                             'e.g. 0/4 (see merge_shards.py)')
+    parser.add_argument('--metrics_textfile', type=Path,
+                        help='path to a Prometheus textfile to export '
+                             'metrics to, which is overwritten, so each '
+                             'script needs its own file')
     return parser.parse_args()
 
 
@@ -6,13 +6,16 @@ from zipfile import ZipFile
 
 
 def main(args):
-    from jaffadata.datasets import AudioSetOntology, FSD50K
+    from jaffadata.datasets import FSD50K
+
+    from ontology import OntologyIndex
 
     dataset_dir = args.work_dir / 'fsd50k'
     if not dataset_dir.is_dir():
         download_fsd50k_data(dataset_dir)
     dataset = FSD50K(dataset_dir)
-    ontology = AudioSetOntology('metadata/ontology.json')
+    ontology = OntologyIndex.load('metadata/ontology.json',
+                                  args.work_dir / 'ontology.npz')
 
     # Filter out audio clips that contain multiple sounds
     train_set = to_single_label(dataset['training'], ontology)
@@ -67,11 +70,15 @@ def to_single_label(subset, ontology):
     # Check if any labels are unrelated to the first label, which
     # would mean that the clip contains more than one type of sound.
     # It is assumed the first label encountered is a leaf node.
-    def _are_unrelated(mids):
-        return any(not ontology[mid].is_ancestor(ontology[mids[0]])
-                   for mid in mids[1:])
-
-    mask = np.fromiter(map(_are_unrelated, subset.tags.mids), dtype=bool)
+    mids = subset.tags.mids
+    lengths = mids.str.len().values
+    indices = ontology.indices(np.concatenate(mids.values))
+    offsets = np.cumsum(lengths) - lengths
+    first = np.repeat(indices[offsets], lengths)
+    clips = np.repeat(np.arange(len(mids)), lengths)
+    unrelated = ~ontology.is_ancestor(indices, first)
+    unrelated[offsets] = False
+    mask = np.bincount(clips[unrelated], minlength=len(mids)) > 0
 
     subset = subset[~mask]
     subset.tags.insert(0, 'label', subset.tags.labels.str[0])
@@ -88,19 +95,13 @@ def filter_classes_by_size(subset, n):
 
 
 def filter_classes_by_ancestry(mids, ontology):
-    def _item(mid):
-        return ontology[mid]
-
-    new_mids = []
-    for mid in mids:
-        # Determine whether the class is an ancestor of any other class
-        is_ancestor = any(_item(mid).is_ancestor(_item(other_mid))
-                          for other_mid in mids)
-        # Include the class if it is not an ancestor
-        if not is_ancestor:
-            new_mids.append(mid)
-
-    return new_mids
+    # Determine whether each class is an ancestor of any other class
+    # and only include the classes that are not ancestors
+    mids = list(mids)
+    indices = ontology.indices(mids)
+    is_ancestor = ontology.is_ancestor(indices[:, None], indices[None, :])
+    return [mid for mid, mask in zip(mids, is_ancestor.any(axis=1))
+            if not mask]
 
 
 def filter_subset_by_class(subset, mids):
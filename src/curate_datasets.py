@@ -5,7 +5,8 @@ from pathlib import Path
 
 def curate(args):
     import pandas as pd
-    from tqdm import tqdm
+
+    from inventory import update_inventory
 
     with open(args.work_dir / 'labels.txt') as f:
         label_set = f.read().strip().split('\n')
@@ -27,22 +28,26 @@ def curate(args):
     # Create DataFrame for ARCA23K annotations
     df = pd.read_csv(args.work_dir / 'download_list.csv', index_col=0)
     mids = pd.read_csv('metadata/fsd50k_mids.csv', index_col=0)
-    df['mid'] = mids.loc[df.prediction].values
+    df['mid'] = mids.loc[df.prediction, 'mid'].values
     df.columns = ['label', 'mid']
     df.index.name = 'fname'
 
-    # Discard DataFrame entries that correspond to non-existing clips
-    for clip_id in tqdm(df.index):
-        path = args.work_dir / f'audio/{clip_id}.wav'
-        n_bytes = path.stat().st_size
-        if not path.exists() or n_bytes < 26460 or n_bytes > 2646500:
-            df.drop([clip_id], inplace=True)
+    # Discard DataFrame entries that correspond to non-existing clips,
+    # clips that were not converted correctly, and clips with a
+    # duration outside [0.3, 30] seconds
+    inventory = update_inventory(args.work_dir)
+    valid = inventory.error.isna() & (inventory.sample_rate == 44100) \
+        & (inventory.channels == 1) & (inventory.bit_depth == 16) \
+        & (inventory.duration >= 0.3) & (inventory.duration <= 30)
+    valid = valid.fillna(False).astype(bool)
+    df = df[df.index.isin(inventory.index[valid])]
 
     # Constrain ARCA23K to be the same size as ARCA23K-FSD
     df_train = select_subset(df, df_train)
 
     # Save ARCA23K annotations
     arca23k_dir = args.work_dir / 'final/ARCA23K.ground_truth'
+    arca23k_dir.mkdir(parents=True, exist_ok=True)
     df_train.to_csv(arca23k_dir / 'train.csv')
     df_val.to_csv(arca23k_dir / 'val.csv')
     df_test.to_csv(arca23k_dir / 'test.csv')
@@ -1,21 +1,38 @@
 import argparse
 import json
+import os
+import re
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 
 
+class Unauthorized(Exception):
+    pass
+
+
 def download(args):
     import pandas as pd
     from tqdm import tqdm
 
-    from extern.freesound import FreesoundClient, FSRequest, URIS
+    from extern.freesound import FreesoundClient, Transport
 
     import utils
+    from inventory import update_inventory
+    from metrics import METRICS, write_report
 
     with open('client.json') as f:
         params = json.load(f)
 
     client = FreesoundClient()
     client.set_token(params['access_token'], auth_type='oauth')
+    client.transport = Transport(pool_size=args.workers)
+
+    # Every shard must select the same subset of clips to download
+    shard = utils.parse_shard(args.shard) if args.shard else None
+    if shard is not None and args.seed is None:
+        raise ValueError('--seed must be specified when using --shard')
 
     # Determine which clips to download
     df = pd.read_csv(args.work_dir / 'freesound_matches.csv', index_col=0)
@@ -23,33 +40,158 @@ def download(args):
         label_set = f.read().strip().split('\n')
 
     # Load query results (to determine file extensions)
-    results = utils.load_freesound_metadata(args.work_dir / 'query')
+    results = utils.load_freesound_metadata(args.work_dir / 'query',
+                                            args.work_dir / 'query.pkl',
+                                            columns=['type'])
     results = results[results.index.isin(df.index)]
     results = results.join(df)
 
     # Select a subset of the clips to download
     # This saves time, space, and bandwidth
-    results = select_subset(results, label_set, args.work_dir)
+    results = select_subset(results, label_set, args.work_dir, args.seed)
+    list_path = args.work_dir / 'download_list.csv'
+    if shard is not None:
+        results = results[utils.shard_mask(results.index, shard)]
+        list_path = utils.shard_path(args.work_dir, list_path.name, shard)
+        list_path.parent.mkdir(exist_ok=True)
 
     # Ensure output directory exists
     download_dir = args.work_dir / 'downloads'
     download_dir.mkdir(parents=True, exist_ok=True)
 
     # Start downloading the selected clips
-    results[['prediction']].to_csv(args.work_dir / 'download_list.csv')
-    for index, row in tqdm(results.iterrows(), total=len(results)):
-        path = Path(download_dir / f'{index}.{row.type}')
-        if not path.exists():
-            uri = URIS.uri(URIS.DOWNLOAD, index)
-            try:
-                FSRequest.retrieve(uri, client, path)
-            except Exception as e:
-                print(f'Unable to download sound {index}\nReason: {str(e)}')
-                if 'Unauthorized' in str(e):
-                    break
-
-
-def select_subset(df, label_set, work_dir):
+    results[['prediction']].to_csv(list_path)
+    inventory = update_inventory(args.work_dir, shard=shard)
+    downloaded = inventory.index[inventory.download_path.notna()]
+    results = results[~results.index.isin(downloaded)]
+    jobs = [(index, download_dir / f'{index}.{row.type}')
+            for index, row in results.iterrows()]
+    with tqdm(total=len(jobs)) as pbar, METRICS.timer('download.total'):
+        download_clips(jobs, client, args.workers, pbar.update)
+
+    # Record the new downloads in the inventory
+    update_inventory(args.work_dir, shard=shard)
+
+    # Report the download throughput
+    report = METRICS.report('download_clips')
+    seconds = report['timers'].get('download.total', {}).get('seconds', 0)
+    n_bytes = report['counters'].get('download.bytes', 0)
+    METRICS.set('download.bytes_per_second', n_bytes / max(seconds, 1e-9))
+    stage = 'download_clips'
+    if shard is not None:
+        stage += f'.{utils.shard_name(shard)}'
+    write_report(args.work_dir, stage, args.metrics_textfile)
+
+
+def download_clips(jobs, client, n_workers=8, callback=None):
+    from extern.freesound import URIS, Transport
+    from metrics import METRICS
+
+    transport = client.transport or Transport.default()
+    headers = {'Authorization': client.header}
+
+    # Once the access token is rejected, all pending downloads are
+    # cancelled, as they would be rejected too
+    stop = threading.Event()
+
+    def _download(job):
+        clip_id, path = job
+        uri = URIS.uri(URIS.DOWNLOAD, clip_id)
+        try:
+            if not stop.is_set():
+                download_file(transport, uri, path, headers)
+                METRICS.inc('download.clips')
+        except Unauthorized:
+            if not stop.is_set():
+                stop.set()
+                print('Access token is invalid or has expired')
+        except Exception as e:
+            METRICS.inc('download.failures')
+            print(f'Unable to download sound {clip_id}\nReason: {str(e)}')
+        finally:
+            # Cancelled jobs are counted too, so that progress is complete
+            if callback is not None:
+                callback(1)
+
+    with ThreadPoolExecutor(n_workers) as executor:
+        list(executor.map(_download, jobs))
+
+
+def download_file(transport, url, path, headers=None, max_retries=5):
+    import requests
+
+    from extern.freesound import FreesoundException
+    from metrics import METRICS
+
+    # Data is written to a .part file first, which is only renamed
+    # once the download is complete. This means that a file at the
+    # final path is never truncated.
+    part_path = path.with_name(path.name + '.part')
+
+    for attempt in range(max_retries + 1):
+        if attempt > 0:
+            METRICS.inc('download.retries')
+
+        # The latency is the time until the first chunk is received
+        start = time.perf_counter()
+        n_bytes = 0
+
+        def _progress(size):
+            nonlocal n_bytes
+            if n_bytes == 0:
+                METRICS.observe('download.http_latency_seconds',
+                                time.perf_counter() - start)
+            n_bytes += size
+            METRICS.inc('download.bytes', size)
+
+        # Resume the download if a partial file exists
+        try:
+            _, response_headers = transport.download(
+                url, str(part_path), headers, resume=True,
+                progress=_progress)
+        except FreesoundException as e:
+            if e.code == 401:
+                raise Unauthorized()
+            if e.code == 429 or e.code >= 500:
+                delay = e.headers.get('Retry-After')
+                time.sleep(_backoff(attempt, delay))
+                continue
+            if e.code == 416:
+                # The partial file is complete if its size is the total
+                # size given by Content-Range (e.g. bytes */1000).
+                # Otherwise, the partial file is no longer valid.
+                match = re.fullmatch(r'bytes \*/(\d+)',
+                                     e.headers.get('Content-Range', ''))
+                if match is not None and \
+                        part_path.stat().st_size == int(match.group(1)):
+                    os.replace(part_path, path)
+                    return
+                part_path.unlink()
+                continue
+            raise e
+        except (requests.ConnectionError, requests.Timeout,
+                requests.exceptions.ChunkedEncodingError):
+            time.sleep(_backoff(attempt))
+            continue
+
+        # Resume the download if the connection was cut short
+        expected = response_headers.get('Content-Length')
+        if expected is not None and n_bytes < int(expected):
+            continue
+
+        os.replace(part_path, path)
+        return
+
+    raise RuntimeError(f'Download failed after {max_retries + 1} attempts')
+
+
+def _backoff(attempt, delay=None):
+    if delay is not None and delay.isdigit():
+        return int(delay)
+    return min(2 ** attempt, 60)
+
+
+def select_subset(df, label_set, work_dir, seed=None):
     import pandas as pd
 
     # Determine minimum number of clips to download per class
@@ -59,7 +201,7 @@ def select_subset(df, label_set, work_dir):
 
     def _sample(x):
         n_samples = target_sizes[x.prediction][0]
-        return x.sample(min(len(x), n_samples + 10))
+        return x.sample(min(len(x), n_samples + 10), random_state=seed)
 
     return df.groupby('prediction').apply(_sample).droplevel(0)
 
@@ -68,6 +210,18 @@ def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--work_dir', type=Path, default=Path('_output'),
                         help='path to workspace directory')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of clips to download at once')
+    parser.add_argument('--shard', metavar='INDEX/COUNT',
+                        help='only download the clips of the given shard, '
+                             'e.g. 0/4 (see merge_shards.py)')
+    parser.add_argument('--seed', type=int,
+                        help='seed for selecting the clips to download '
+                             '(required when using --shard)')
+    parser.add_argument('--metrics_textfile', type=Path,
+                        help='path to a Prometheus textfile to export '
+                             'metrics to, which is overwritten, so each '
+                             'script needs its own file')
     return parser.parse_args()
 
 
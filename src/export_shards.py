@@ -0,0 +1,118 @@
+import argparse
+import heapq
+import io
+import json
+import os
+import random
+import sys
+import tarfile
+from concurrent.futures import ThreadPoolExecutor
+from pathlib import Path
+
+
+def export(args):
+    import pandas as pd
+
+    import utils
+
+    jobs = []
+    indexes = []
+    for (dataset, split), audio_dir in utils.split_audio_dirs(
+            args.work_dir).items():
+        gt_path = args.work_dir / f'final/{dataset}.ground_truth/{split}.csv'
+        df = pd.read_csv(gt_path, index_col=0)
+        paths = [audio_dir / f'{fname}.wav' for fname in df.index]
+        sizes = [path.stat().st_size for path in paths]
+
+        # Shuffle the clips so that each shard has a random sample
+        # The shuffle is seeded so that the shards are reproducible
+        rng = random.Random(f'{args.seed}:{dataset}:{split}')
+        order = list(range(len(df)))
+        rng.shuffle(order)
+        shards = assign_shards([sizes[i] for i in order], args.shard_size)
+
+        n_shards = max(shards, default=-1) + 1
+        names = [f'{split}-{shard:06d}.tar' for shard in range(n_shards)]
+        members = [[] for _ in names]
+        shuffled = df.iloc[order]
+        for (fname, row), i, shard in zip(shuffled.iterrows(), order, shards):
+            members[shard].append((fname, paths[i], row))
+
+        output_dir = args.work_dir / f'final/{dataset}.shards'
+        output_dir.mkdir(parents=True, exist_ok=True)
+        jobs += [(output_dir / name, split_members)
+                 for name, split_members in zip(names, members)]
+
+        # The index maps each clip to its shard
+        index = shuffled.assign(shard=[names[shard] for shard in shards])
+        indexes.append((output_dir, split, names, index))
+
+    # Write the shards of every split concurrently. The shards are
+    # written to temporary files first, so that the previous export is
+    # kept intact if the export is interrupted.
+    with ThreadPoolExecutor(args.workers) as executor:
+        tmp_paths = list(executor.map(lambda job: write_shard(*job), jobs))
+    for (path, _), tmp_path in zip(jobs, tmp_paths):
+        os.replace(tmp_path, path)
+        print(f'Wrote {path.parent.name}/{path.name}')
+
+    for output_dir, split, names, index in indexes:
+        tmp_path = output_dir / f'{split}.csv.part'
+        index.to_csv(tmp_path)
+        os.replace(tmp_path, output_dir / f'{split}.csv')
+
+        # Remove the shards of a previous export that are not replaced
+        for path in output_dir.glob(f'{split}-*.tar'):
+            if path.name not in names:
+                path.unlink()
+
+
+def assign_shards(sizes, shard_size):
+    # Assign each clip, in order, to the shard with the fewest bytes so
+    # far, so that the shards are about the same size
+    n_shards = max(1, -(-sum(sizes) // shard_size))
+    heap = [(0, shard) for shard in range(n_shards)]
+    shards = []
+    for size in sizes:
+        total, shard = heapq.heappop(heap)
+        shards.append(shard)
+        heapq.heappush(heap, (total + size, shard))
+    return shards
+
+
+def write_shard(path, members):
+    # Each sample is a WAV file and a JSON file with the same basename,
+    # which is the format expected by WebDataset. The metadata of the
+    # tar members is fixed so that the shards are reproducible. The
+    # shard is written to a temporary file, whose path is returned.
+    def _add(tar, name, f, size):
+        info = tarfile.TarInfo(name)
+        info.size = size
+        info.mode = 0o644
+        tar.addfile(info, f)
+
+    tmp_path = path.with_name(path.name + '.part')
+    with tarfile.open(tmp_path, 'w', format=tarfile.USTAR_FORMAT) as tar:
+        for fname, wav_path, row in members:
+            with open(wav_path, 'rb') as f:
+                _add(tar, f'{fname}.wav', f, os.fstat(f.fileno()).st_size)
+            data = json.dumps({'label': row.label, 'mid': row.mid}).encode()
+            _add(tar, f'{fname}.json', io.BytesIO(data), len(data))
+    return tmp_path
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=Path, default=Path('_output'),
+                        help='path to workspace directory')
+    parser.add_argument('--shard_size', type=int, default=2 ** 28,
+                        help='target size of each shard in bytes')
+    parser.add_argument('--seed', type=int, default=1000,
+                        help='seed for shuffling the clips')
+    parser.add_argument('--workers', type=int, default=4,
+                        help='number of shards to write at once')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(export(parse_args()))
@@ -14,24 +14,31 @@ requires Oauth2 authentication
 (see http://freesound.org/docs/api/authentication.html). Oauth2 authentication
 is supported, but you are expected to implement the workflow.
 """
+import hashlib
+import io
 import os
 import re
 import json
+import tempfile
+import threading
+import time
+
+import requests
 
 try:  # python 3
-    from urllib.request import urlopen, FancyURLopener, Request  # noqa
-    from urllib.parse import urlencode, quote
-    from urllib.error import HTTPError
+    from urllib.parse import urlencode, quote, parse_qsl, urlsplit, \
+        urlunsplit
     py3 = True
 except ImportError:  # python 2.7
-    from urllib import urlencode, FancyURLopener, quote
-    from urllib2 import HTTPError, urlopen, Request
+    from urllib import urlencode, quote
+    from urlparse import parse_qsl, urlsplit, urlunsplit
     py3 = False
 
 
 class URIS():
     HOST = 'freesound.org'
-    BASE = 'https://' + HOST + '/apiv2'
+    # The base URL can be overridden e.g. to use a local test server
+    BASE = os.environ.get('FREESOUND_API_BASE', 'https://' + HOST + '/apiv2')
     TEXT_SEARCH = '/search/text/'
     CONTENT_SEARCH = '/search/content/'
     COMBINED_SEARCH = '/search/combined/'
@@ -77,6 +84,8 @@ class FreesoundClient():
     client_id = ""
     token = ""
     header = ""
+    transport = None  # Use the shared transport by default
+    cache = None  # Set to a ResponseCache to cache API responses
 
     def get_sound(self, sound_id, **params):
         """
@@ -197,32 +206,238 @@ class FreesoundException(Exception):
     """
     Freesound API exception
     """
-    def __init__(self, http_code, detail):
+    def __init__(self, http_code, detail, headers=None):
         self.code = http_code
         self.detail = detail
+        self.headers = headers or {}
 
     def __str__(self):
         return '<FreesoundException: code=%s, detail="%s">' % \
                 (self.code,  self.detail)
 
 
-class Retriever(FancyURLopener):
+class Transport():
+    """
+    Sends requests over a pool of persistent (keep-alive) connections.
+    API responses are requested with gzip compression. Clients share a
+    single transport unless they are given their own:
+    >>> c.transport = Transport(pool_size=4, timeout=(5, 30))
+    """
+    _default = None
+    _lock = threading.Lock()
+
+    def __init__(self, pool_size=10, timeout=(10, 60)):
+        self.timeout = timeout
+        self.session = requests.Session()
+        self.session.headers['Accept-Encoding'] = 'gzip'
+        adapter = requests.adapters.HTTPAdapter(pool_connections=pool_size,
+                                                pool_maxsize=pool_size)
+        self.session.mount('https://', adapter)
+        self.session.mount('http://', adapter)
+
+    @classmethod
+    def default(cls):
+        with cls._lock:
+            if cls._default is None:
+                cls._default = cls()
+            return cls._default
+
+    def send(self, url, headers=None, data=None, stream=False):
+        method = 'POST' if data else 'GET'
+        response = self.session.request(method, url, headers=headers,
+                                        data=data, stream=stream,
+                                        timeout=self.timeout)
+        if not response.ok:
+            resp = response.content
+            response.close()
+            try:
+                detail = json.loads(resp)
+            except ValueError:  # e.g. an error page from a proxy
+                detail = resp.decode('utf-8', 'replace')
+            raise FreesoundException(response.status_code, detail,
+                                     response.headers)
+        return response
+
+    def download(self, url, path, headers=None, chunk_size=2 ** 16,
+                 resume=False, progress=None):
+        """
+        Download a file to disk in chunks without loading it into memory.
+        If resume is True and the file exists, only the rest of the file
+        is requested and appended to it. If given, progress is called
+        with the size of each chunk as it is written.
+        """
+        # Audio files are already compressed
+        headers = dict(headers or {}, **{'Accept-Encoding': 'identity'})
+        offset = os.path.getsize(path) if resume and \
+            os.path.exists(path) else 0
+        if offset > 0:
+            headers['Range'] = 'bytes=%d-' % offset
+        with self.send(url, headers, stream=True) as response:
+            # The server may ignore the Range header
+            mode = 'ab' if response.status_code == 206 else 'wb'
+            with open(path, mode) as f:
+                for chunk in response.iter_content(chunk_size):
+                    f.write(chunk)
+                    if progress is not None:
+                        progress(len(chunk))
+        return path, response.headers
+
+
+class ResponseCache():
     """
-    Downloads previews and original sound files to disk.
+    Caches API responses on disk, keyed by their normalized URL and the
+    Authorization header. Cached responses older than the TTL (in seconds),
+    or that are requested with revalidate=True, are revalidated using their
+    ETag or Last-Modified headers. The least recently used responses are
+    evicted once the cache exceeds max_size bytes. Entries are written
+    atomically, so a cache directory (e.g. ~/.cache/freesound) can be
+    shared by several processes. The size of the cache is recounted every
+    recount_interval seconds to include the entries of other processes.
+    >>> c.cache = ResponseCache(os.path.expanduser("~/.cache/freesound"))
     """
-    def http_error_default(self, url, fp, errcode, errmsg, headers):
-        resp = fp.read()
+    def __init__(self, path, ttl=86400, max_size=2 ** 30,
+                 recount_interval=60):
+        self.path = path
+        self.ttl = ttl
+        self.max_size = max_size
+        self.recount_interval = recount_interval
+        self._lock = threading.Lock()
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        self._recount()
+
+    @staticmethod
+    def normalize(url):
+        # Parameters are sorted so that their order does not matter
+        parts = urlsplit(url)
+        query = urlencode(sorted(parse_qsl(parts.query, True)))
+        return urlunsplit((parts.scheme.lower(), parts.netloc.lower(),
+                           parts.path, query, ''))
+
+    def fetch(self, transport, url, headers, revalidate=False):
+        """
+        Return the body of the response to a GET request for the URL,
+        which is only sent if the cached response is missing or stale.
+        """
+        url = self.normalize(url)
+        # Responses may differ between users, so the token is part of the key
+        key = url + '\n' + headers.get('Authorization', '')
+        path = os.path.join(self.path,
+                            hashlib.sha256(key.encode()).hexdigest())
+        entry = self._read(path)
+        if entry is not None and not revalidate \
+                and time.time() - entry[0]['time'] < self.ttl:
+            try:
+                os.utime(path, None)  # Mark as recently used
+                return entry[1]
+            except OSError:  # Evicted by another process
+                entry = None
+        if entry is not None:
+            meta, body = entry
+
+            # Ask the server to only send the body if it has changed
+            headers = dict(headers)
+            if meta.get('etag'):
+                headers['If-None-Match'] = meta['etag']
+            if meta.get('last_modified'):
+                headers['If-Modified-Since'] = meta['last_modified']
+
+        response = transport.send(url, headers)
+        if response.status_code == 304 and entry is not None:
+            body = entry[1]
+        else:
+            body = response.content
+            meta = {'url': url}
+        meta['time'] = time.time()
+        meta['etag'] = response.headers.get('ETag', meta.get('etag'))
+        meta['last_modified'] = response.headers.get(
+            'Last-Modified', meta.get('last_modified'))
+        self._write(path, meta, body)
+        return body
+
+    def _read(self, path):
+        # Each entry is a line of JSON metadata followed by the body
         try:
-            error = json.loads(resp)
-            raise FreesoundException(errcode, error.detail)
-        except:
-            raise Exception(resp)
+            with open(path, 'rb') as f:
+                meta = json.loads(f.readline().decode())
+                return meta, f.read()
+        except (IOError, OSError, ValueError):
+            return None
+
+    def _write(self, path, meta, body):
+        data = json.dumps(meta).encode() + b'\n' + body
+        fd, tmp_path = tempfile.mkstemp(dir=self.path, suffix='.part')
+        with os.fdopen(fd, 'wb') as f:
+            f.write(data)
+        # An existing entry is replaced, so its size no longer counts
+        try:
+            old_size = os.path.getsize(path)
+        except OSError:
+            old_size = 0
+        os.replace(tmp_path, path)
+
+        with self._lock:
+            self._size += len(data) - old_size
+            if time.time() - self._count_time > self.recount_interval:
+                self._recount()
+            if self._size > self.max_size:
+                self._evict()
+
+    def _entries(self):
+        for name in os.listdir(self.path):
+            if name.endswith('.part'):
+                continue
+            try:
+                stat = os.stat(os.path.join(self.path, name))
+            except OSError:  # Removed by another process
+                continue
+            yield name, stat.st_mtime, stat.st_size
+
+    def _recount(self):
+        self._size = sum(size for _, _, size in self._entries())
+        self._count_time = time.time()
+
+    def _evict(self):
+        # Remove the least recently used entries until the cache is 10%
+        # below its maximum size, so that eviction does not run often
+        entries = sorted(self._entries(), key=lambda entry: entry[1])
+        self._size = sum(size for _, _, size in entries)
+        for name, _, size in entries:
+            if self._size <= 0.9 * self.max_size:
+                break
+            try:
+                os.remove(os.path.join(self.path, name))
+            except OSError:
+                pass
+            self._size -= size
 
 
 class FSRequest:
     """
     Makes requests to the freesound API. Should not be used directly.
     """
+    @classmethod
+    def open(cls, uri, params={}, client=None, data=False, revalidate=False):
+        """
+        Send a request and return the response without reading its body,
+        so that the caller can stream it (e.g. straight to disk). If
+        revalidate is True, a cached response is revalidated even if it
+        is still fresh.
+        """
+        p = params if params else {}
+        url = '%s?%s' % (uri, urlencode(p)) if params else uri
+        d = urlencode(data) if data else None
+        headers = {'Authorization': client.header}
+        transport = client.transport or Transport.default()
+        if client.cache is not None and not d:
+            return io.BytesIO(
+                client.cache.fetch(transport, url, headers, revalidate))
+
+        response = transport.send(url, headers, d, stream=True)
+        # Decompress the body when it is read
+        response.raw.decode_content = True
+        return response.raw
+
     @classmethod
     def request(
             cls,
@@ -231,21 +446,10 @@ class FSRequest:
             client=None,
             wrapper=FreesoundObject,
             method='GET',
-            data=False
+            data=False,
+            revalidate=False
             ):
-        p = params if params else {}
-        url = '%s?%s' % (uri, urlencode(p)) if params else uri
-        d = urlencode(data) if data else None
-        headers = {'Authorization': client.header}
-        req = Request(url, d, headers)
-        try:
-            f = urlopen(req)
-        except HTTPError as e:
-            resp = e.read()
-            if e.code >= 200 and e.code < 300:
-                return resp
-            else:
-                raise FreesoundException(e.code, json.loads(resp))
+        f = cls.open(uri, params, client, data, revalidate)
         if py3:
             resp = f.read().decode("utf-8")
         else:
@@ -262,9 +466,9 @@ class FSRequest:
 
     @classmethod
     def retrieve(cls, url, client, path):
-        r = Retriever()
-        r.addheader('Authorization', client.header)
-        return r.retrieve(url, path)
+        headers = {'Authorization': client.header}
+        transport = client.transport or Transport.default()
+        return transport.download(url, path, headers)
 
 
 class Pager(FreesoundObject):
@@ -0,0 +1,164 @@
+import argparse
+import json
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
+from pathlib import Path
+
+import numpy as np
+
+
+def extract(args):
+    import pandas as pd
+    from tqdm import tqdm
+
+    import utils
+    from features import n_frames
+    from wavfile import read_info
+
+    params = {
+        'sample_rate': args.sample_rate,
+        'n_fft': args.n_fft,
+        'hop_length': args.hop_length,
+        'n_mels': args.n_mels,
+    }
+
+    # The features are stored by source rather than by split, as the
+    # splits of ARCA23K and ARCA23K-FSD share many clips (see
+    # utils.SPLIT_SOURCES). Each clip's features are only stored once.
+    audio_dirs = utils.source_audio_dirs(args.work_dir)
+    output_dir = args.work_dir / 'final/features'
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for source, fnames in utils.source_fnames(args.work_dir).items():
+        paths = [audio_dirs[source] / f'{fname}.wav' for fname in fnames]
+
+        index = pd.DataFrame(index=pd.Index(fnames, name='fname'))
+        stats = [path.stat() for path in paths]
+        index['wav_size'] = [stat.st_size for stat in stats]
+        index['wav_mtime'] = [stat.st_mtime_ns for stat in stats]
+
+        output_path = output_dir / source
+        old_index, old_data = _load_store(output_path, params)
+
+        # Only compute the features of clips whose WAV file has changed
+        # since the features were last computed
+        unchanged = pd.Series(False, index=index.index)
+        lengths = pd.Series(0, index=index.index)
+        if old_index is not None:
+            old = old_index.astype('Int64').reindex(index.index)
+            unchanged = (old.wav_size == index.wav_size) \
+                & (old.wav_mtime == index.wav_mtime)
+            unchanged = unchanged.fillna(False).astype(bool)
+            lengths[unchanged] = old.length[unchanged].astype(int)
+
+        # Determine the number of frames of the other clips from their
+        # headers
+        for path, fname in zip(paths, index.index):
+            if unchanged[fname]:
+                continue
+            info = read_info(path)
+            if info.sample_rate != args.sample_rate or info.channels != 1:
+                raise ValueError(f'{path} is not a mono {args.sample_rate} '
+                                 'Hz WAV file')
+            lengths[fname] = n_frames(info.n_frames, args.n_fft,
+                                      args.hop_length)
+        index['length'] = lengths
+        index['offset'] = index.length.cumsum() - index.length
+
+        # Write the features to a temporary file first so that the
+        # old features can be reused. Features are copied from the old
+        # store and computed ones are written by the worker processes.
+        tmp_path = output_dir / f'{source}.npy.part'
+        shape = (int(index.length.sum()), args.n_mels)
+        data = np.lib.format.open_memmap(tmp_path, mode='w+',
+                                         dtype=np.float32, shape=shape)
+        for fname in index.index[unchanged]:
+            src = old_index.loc[fname]
+            dst = index.loc[fname]
+            data[dst.offset:dst.offset + dst.length] = \
+                old_data[src.offset:src.offset + src.length]
+        data.flush()
+        del data, old_data
+
+        jobs = [(path, offset, length) for path, offset, length, skip
+                in zip(paths, index.offset, index.length, unchanged)
+                if not skip]
+        with ProcessPoolExecutor(args.workers, initializer=_init_worker,
+                                 initargs=(tmp_path, params)) as executor:
+            list(tqdm(executor.map(_extract, jobs, chunksize=16),
+                      total=len(jobs)))
+
+        # The parameters are written last, as the features are only
+        # reused if the parameters exist (see _load_store)
+        Path(f'{output_path}.json').unlink(missing_ok=True)
+        os.replace(tmp_path, f'{output_path}.npy')
+        index.to_csv(f'{output_path}.csv')
+        with open(f'{output_path}.json', 'w') as f:
+            json.dump(params, f, indent=2)
+
+        print(f'Computed features of {len(jobs)} clips and reused '
+              f'{unchanged.sum()} for features/{source}')
+
+
+def _load_store(path, params):
+    # Features can only be reused if they were computed the same way
+    try:
+        with open(f'{path}.json') as f:
+            if json.load(f) != params:
+                return None, None
+
+        import pandas as pd
+
+        index = pd.read_csv(f'{path}.csv', index_col=0)
+        data = np.load(f'{path}.npy', mmap_mode='r')
+        return index, data
+    except FileNotFoundError:
+        return None, None
+
+
+_worker_data = None
+_worker_params = None
+_worker_filterbank = None
+
+
+def _init_worker(path, params):
+    from features import mel_filterbank
+
+    global _worker_data, _worker_params, _worker_filterbank
+    _worker_data = np.load(path, mmap_mode='r+')
+    _worker_params = params
+    _worker_filterbank = mel_filterbank(params['sample_rate'],
+                                        params['n_fft'], params['n_mels'])
+
+
+def _extract(job):
+    from audio_archive import read_samples
+    from features import log_mel
+
+    path, offset, length = job
+    _, samples = read_samples(path)
+    x = np.frombuffer(samples, dtype='<i2') / 2 ** 15
+    features = log_mel(x, _worker_filterbank, _worker_params['n_fft'],
+                       _worker_params['hop_length'])
+    _worker_data[offset:offset + length] = features
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=Path, default=Path('_output'),
+                        help='path to workspace directory')
+    parser.add_argument('--sample_rate', type=int, default=44100,
+                        help='expected sample rate of the audio clips')
+    parser.add_argument('--n_fft', type=int, default=1024,
+                        help='length of each STFT frame in samples')
+    parser.add_argument('--hop_length', type=int, default=512,
+                        help='number of samples between STFT frames')
+    parser.add_argument('--n_mels', type=int, default=64,
+                        help='number of mel bins')
+    parser.add_argument('--workers', type=int, default=os.cpu_count(),
+                        help='number of processes to run at once')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(extract(parse_args()))
@@ -0,0 +1,66 @@
+import numpy as np
+import pandas as pd
+
+
+# A feature store holds the log-mel spectrograms of many clips in a
+# single array (PATH.npy) of shape (n_frames, n_mels), one clip after
+# another, and an index (PATH.csv) that gives the offset and length (in
+# frames) of each clip by file name.
+
+
+class FeatureStore:
+    def __init__(self, path):
+        self.index = pd.read_csv(f'{path}.csv', index_col=0)
+        self._offsets = dict(zip(self.index.index, self.index.offset))
+        self._lengths = dict(zip(self.index.index, self.index.length))
+        self.data = np.load(f'{path}.npy', mmap_mode='r')
+
+    def __getitem__(self, fname):
+        # Return a view of the clip's features without copying them
+        offset = self._offsets[fname]
+        return self.data[offset:offset + self._lengths[fname]]
+
+    def __contains__(self, fname):
+        return fname in self._offsets
+
+    def __iter__(self):
+        return iter(self.index.index)
+
+    def __len__(self):
+        return len(self.index)
+
+
+def mel_filterbank(sample_rate, n_fft, n_mels, f_min=0, f_max=None):
+    # Triangular filters evenly spaced on the (HTK) mel scale
+    def _hz_to_mel(f):
+        return 2595 * np.log10(1 + f / 700)
+
+    def _mel_to_hz(m):
+        return 700 * (10 ** (m / 2595) - 1)
+
+    f_max = f_max or sample_rate / 2
+    mels = np.linspace(_hz_to_mel(f_min), _hz_to_mel(f_max), n_mels + 2)
+    hz = _mel_to_hz(mels)
+    freqs = np.fft.rfftfreq(n_fft, 1 / sample_rate)
+    lower = (freqs - hz[:-2, None]) / (hz[1:-1] - hz[:-2])[:, None]
+    upper = (hz[2:, None] - freqs) / (hz[2:] - hz[1:-1])[:, None]
+    return np.maximum(0, np.minimum(lower, upper))
+
+
+def n_frames(n_samples, n_fft, hop_length):
+    # The signal is padded by n_fft // 2 on both sides
+    return (n_samples + 2 * (n_fft // 2) - n_fft) // hop_length + 1
+
+
+def log_mel(x, filterbank, n_fft, hop_length):
+    pad = n_fft // 2
+    mode = 'reflect' if len(x) > pad else 'constant'
+    x = np.pad(x, pad, mode=mode)
+
+    # Compute the STFT of all frames at once
+    frames = np.lib.stride_tricks.sliding_window_view(x, n_fft)
+    frames = frames[::hop_length] * np.hanning(n_fft + 1)[:-1]
+    power = np.abs(np.fft.rfft(frames, axis=1)) ** 2
+
+    mel = power @ filterbank.T
+    return np.log(mel + 1e-8).astype(np.float32)
@@ -0,0 +1,133 @@
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+import numpy as np
+import pandas as pd
+
+from utils import shard_mask, shard_path
+from wavfile import WavError, read_info
+
+
+INT_COLUMNS = [
+    'download_size',
+    'download_mtime',
+    'audio_size',
+    'audio_mtime',
+    'sample_rate',
+    'channels',
+    'bit_depth',
+    'n_frames',
+]
+
+WAV_COLUMNS = [
+    'sample_rate',
+    'channels',
+    'bit_depth',
+    'n_frames',
+    'duration',
+    'error',
+]
+
+COLUMNS = [
+    'download_path',
+    'download_size',
+    'download_mtime',
+    'audio_path',
+    'audio_size',
+    'audio_mtime',
+] + WAV_COLUMNS
+
+
+def update_inventory(work_dir, n_workers=8, shard=None):
+    # Sweep the download and audio directories
+    downloads = scan_dir(work_dir, 'downloads')
+    audio = scan_dir(work_dir, 'audio', suffix='.wav')
+    downloads.columns = ['download_' + col for col in downloads.columns]
+    audio.columns = ['audio_' + col for col in audio.columns]
+    inventory = downloads.join(audio, how='outer')
+    inventory.index.name = 'id'
+
+    # A shard has its own inventory of the clips assigned to it
+    if shard is not None:
+        inventory = inventory[shard_mask(inventory.index, shard)]
+
+    # Reuse the header information of audio files that have not
+    # changed since the inventory was last updated
+    inventory = inventory.reindex(columns=COLUMNS)
+    inventory = inventory.astype(dict.fromkeys(INT_COLUMNS, 'Int64'))
+    inventory['error'] = inventory.error.astype(object)
+    checked = pd.Series(False, index=inventory.index)
+    # Inventories written by older versions have no header information,
+    # so every audio file is read again
+    old = read_inventory(work_dir, shard)
+    if old is not None and set(WAV_COLUMNS) <= set(old.columns):
+        old = old.reindex(inventory.index)
+        unchanged = (old.audio_size == inventory.audio_size) \
+            & (old.audio_mtime == inventory.audio_mtime)
+        checked = unchanged.fillna(False).astype(bool)
+        inventory.loc[checked, WAV_COLUMNS] = old.loc[checked, WAV_COLUMNS]
+
+    # Read the headers of the remaining audio files
+    paths = inventory.audio_path[inventory.audio_path.notna() & ~checked]
+    with ThreadPoolExecutor(n_workers) as executor:
+        infos = executor.map(wav_info, [work_dir / path for path in paths])
+        infos = pd.DataFrame(list(infos), index=paths.index,
+                             columns=WAV_COLUMNS)
+    infos = infos.astype(inventory.dtypes[WAV_COLUMNS].to_dict())
+    inventory.loc[infos.index, WAV_COLUMNS] = infos
+
+    write_inventory(work_dir, inventory, shard)
+    return inventory
+
+
+def inventory_path(work_dir, shard=None):
+    if shard is None:
+        return work_dir / 'inventory.csv'
+    return shard_path(work_dir, 'inventory.csv', shard)
+
+
+def read_inventory(work_dir, shard=None):
+    path = inventory_path(work_dir, shard)
+    if not path.exists():
+        return None
+    dtype = dict.fromkeys(INT_COLUMNS, 'Int64')
+    return pd.read_csv(path, index_col=0, dtype=dtype,
+                       float_precision='round_trip')
+
+
+def write_inventory(work_dir, inventory, shard=None):
+    # Write to a temporary file first to avoid partial writes
+    path = inventory_path(work_dir, shard)
+    path.parent.mkdir(exist_ok=True)
+    tmp_path = path.with_name(path.name + '.part')
+    inventory[COLUMNS].sort_index().to_csv(tmp_path)
+    os.replace(tmp_path, path)
+
+
+def scan_dir(work_dir, name, suffix=None):
+    entries = []
+    if (work_dir / name).is_dir():
+        with os.scandir(work_dir / name) as it:
+            for entry in it:
+                stem, ext = os.path.splitext(entry.name)
+                # Skip partial files and files not named after a clip
+                if not stem.isdigit() or ext == '.part' \
+                        or (suffix is not None and ext != suffix):
+                    continue
+
+                stat = entry.stat()
+                entries.append((int(stem), f'{name}/{entry.name}',
+                                stat.st_size, stat.st_mtime_ns))
+
+    columns = ['id', 'path', 'size', 'mtime']
+    df = pd.DataFrame(entries, columns=columns).set_index('id')
+    return df.astype({'size': 'Int64', 'mtime': 'Int64'})
+
+
+def wav_info(path):
+    try:
+        info = read_info(path)
+    except (WavError, OSError, ValueError) as e:
+        return [pd.NA] * 4 + [np.nan, str(e)]
+    return [info.sample_rate, info.channels, info.bit_depth,
+            info.n_frames, info.duration, None]
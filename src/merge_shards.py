@@ -0,0 +1,62 @@
+import argparse
+import sys
+from pathlib import Path
+
+
+def merge(args):
+    import pandas as pd
+
+    import utils
+    from inventory import read_inventory, write_inventory
+    from retrieve import read_metadata, write_matches
+
+    shards = [(index, args.shards) for index in range(args.shards)]
+
+    def _paths(name):
+        # Return the paths of the shards' outputs if every shard has
+        # written the output and an empty list if none of them have
+        paths = [utils.shard_path(args.work_dir, name, shard)
+                 for shard in shards]
+        missing = [path.name for path in paths if not path.exists()]
+        if 0 < len(missing) < len(paths):
+            raise FileNotFoundError(f'Missing shards: {", ".join(missing)}')
+        return [] if missing else paths
+
+    # The classes to keep are determined using the matches of all shards
+    paths = _paths('freesound_matches.csv')
+    if paths:
+        results = pd.concat([pd.read_csv(path, index_col=0)
+                             for path in paths]).sort_index()
+        write_matches(args.work_dir, results,
+                      read_metadata(args.work_dir / 'subset'))
+        print(f'Merged {len(results)} matches from {len(paths)} shards')
+
+    paths = _paths('download_list.csv')
+    if paths:
+        df = pd.concat([pd.read_csv(path, index_col=0) for path in paths])
+        df.sort_index().to_csv(args.work_dir / 'download_list.csv')
+        print(f'Merged {len(df)} download list entries')
+
+    if _paths('inventory.csv'):
+        inventory = pd.concat([read_inventory(args.work_dir, shard)
+                               for shard in shards])
+        write_inventory(args.work_dir, inventory)
+        print(f'Merged {len(inventory)} inventory entries')
+
+    paths = _paths('conversion_errors.csv')
+    if paths:
+        df = pd.concat([pd.read_csv(path) for path in paths])
+        df.to_csv(args.work_dir / 'conversion_errors.csv', index=False)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=Path, default=Path('_output'),
+                        help='path to workspace directory')
+    parser.add_argument('--shards', type=int, required=True,
+                        help='number of shards to merge')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(merge(parse_args()))
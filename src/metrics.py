@@ -0,0 +1,186 @@
+import json
+import os
+import re
+import threading
+import time
+from contextlib import contextmanager
+from datetime import datetime, timezone
+
+
+LATENCY_BUCKETS = [0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60]
+
+
+class Metrics:
+    # Thread-safe collection of counters, gauges, timers, and histograms.
+    # To aggregate metrics across processes, workers can send the result
+    # of collect() to the parent process, which passes it to merge().
+    # Counters and gauges may have labels, e.g. inc(name, code=404).
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.start_time = time.time()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.counters = {}
+            self.gauges = {}
+            self.timers = {}
+            self.histograms = {}
+
+    def inc(self, name, value=1, **labels):
+        name = _key(name, labels)
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def set(self, name, value, **labels):
+        with self.lock:
+            self.gauges[_key(name, labels)] = value
+
+    def add_time(self, name, seconds, count=1):
+        with self.lock:
+            timer = self.timers.setdefault(name, [0, 0.0])
+            timer[0] += count
+            timer[1] += seconds
+
+    @contextmanager
+    def timer(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(name, time.perf_counter() - start)
+
+    def observe(self, name, value, buckets=LATENCY_BUCKETS):
+        with self.lock:
+            hist = self.histograms.setdefault(name, {
+                'buckets': list(buckets),
+                'counts': [0] * (len(buckets) + 1),
+                'sum': 0.0,
+            })
+            index = sum(value > bound for bound in hist['buckets'])
+            hist['counts'][index] += 1
+            hist['sum'] += value
+
+    def collect(self):
+        # Return the metrics recorded so far and reset them
+        with self.lock:
+            snapshot = {'counters': self.counters,
+                        'gauges': self.gauges,
+                        'timers': self.timers,
+                        'histograms': self.histograms}
+            self.counters, self.gauges = {}, {}
+            self.timers, self.histograms = {}, {}
+        return snapshot
+
+    def merge(self, snapshot):
+        for name, value in snapshot['counters'].items():
+            self.inc(name, value)
+        with self.lock:
+            self.gauges.update(snapshot['gauges'])
+        for name, (count, seconds) in snapshot['timers'].items():
+            self.add_time(name, seconds, count)
+        with self.lock:
+            for name, other in snapshot['histograms'].items():
+                hist = self.histograms.setdefault(name, {
+                    'buckets': other['buckets'],
+                    'counts': [0] * len(other['counts']),
+                    'sum': 0.0,
+                })
+                hist['counts'] = [a + b for a, b in zip(hist['counts'],
+                                                        other['counts'])]
+                hist['sum'] += other['sum']
+
+    def report(self, stage):
+        with self.lock:
+            return {
+                'stage': stage,
+                'started': datetime.fromtimestamp(
+                    self.start_time, timezone.utc).isoformat(),
+                'elapsed_seconds': time.time() - self.start_time,
+                'counters': dict(self.counters),
+                'gauges': dict(self.gauges),
+                'timers': {name: {'count': count, 'seconds': seconds}
+                           for name, (count, seconds) in self.timers.items()},
+                'histograms': {name: dict(hist)
+                               for name, hist in self.histograms.items()},
+            }
+
+
+METRICS = Metrics()
+
+
+def _key(name, labels):
+    # Labels are kept in the name in the Prometheus format, e.g.
+    # query.http_errors{code="404"}, so that snapshots can be merged
+    if not labels:
+        return name
+    pairs = ','.join(f'{k}="{v}"' for k, v in sorted(labels.items()))
+    return f'{name}{{{pairs}}}'
+
+
+def write_report(work_dir, stage, textfile_path=None, metrics=METRICS):
+    # Write a JSON report to the work directory
+    report = metrics.report(stage)
+    report_dir = work_dir / 'reports'
+    report_dir.mkdir(parents=True, exist_ok=True)
+    _write_atomic(report_dir / f'{stage}.json', json.dumps(report, indent=2))
+
+    # Optionally export the metrics for the Prometheus node exporter
+    # The file is overwritten, so each stage needs its own file
+    if textfile_path is not None:
+        _write_atomic(textfile_path, to_prometheus(report))
+
+    return report
+
+
+def to_prometheus(report):
+    lines = []
+    stage = f'stage="{report["stage"]}"'
+    typed = set()
+
+    def _sample(name, kind, value, labels=''):
+        # Add the TYPE line before the first sample of each metric
+        name = 'arca23k_' + re.sub(r'[^a-zA-Z0-9_]', '_', name)
+        family = re.sub(r'_(sum|count|bucket)$', '', name) \
+            if kind in ('summary', 'histogram') else name
+        if family not in typed:
+            typed.add(family)
+            lines.append(f'# TYPE {family} {kind}')
+        labels = ','.join(filter(None, [stage, labels]))
+        lines.append(f'{name}{{{labels}}} {value}')
+
+    _sample('elapsed_seconds', 'gauge', report['elapsed_seconds'])
+    for key, value in report['counters'].items():
+        name, labels = _split_key(key)
+        _sample(f'{name}_total', 'counter', value, labels)
+    for key, value in report['gauges'].items():
+        name, labels = _split_key(key)
+        _sample(name, 'gauge', value, labels)
+    for name, timer in report['timers'].items():
+        _sample(f'{name}_seconds_sum', 'summary', timer['seconds'])
+        _sample(f'{name}_seconds_count', 'summary', timer['count'])
+    for name, hist in report['histograms'].items():
+        cumulative = 0
+        bounds = hist['buckets'] + ['+Inf']
+        for bound, count in zip(bounds, hist['counts']):
+            cumulative += count
+            _sample(f'{name}_bucket', 'histogram', cumulative,
+                    f'le="{bound}"')
+        _sample(f'{name}_sum', 'histogram', hist['sum'])
+        _sample(f'{name}_count', 'histogram', cumulative)
+
+    return '\n'.join(lines) + '\n'
+
+
+def _split_key(key):
+    # Split e.g. query.http_errors{code="404"} into its name and labels
+    name, _, labels = key.partition('{')
+    return name, labels.rstrip('}')
+
+
+def _write_atomic(path, text):
+    tmp_path = f'{path}.part'
+    with open(tmp_path, 'w') as f:
+        f.write(text)
+    os.replace(tmp_path, path)
@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+
+class OntologyIndex:
+    # Each class of the AudioSet ontology is assigned an integer id and
+    # the ancestry relations are precomputed as a boolean matrix, so
+    # that ancestry checks are array lookups. The ontology is a graph
+    # in which some classes have several parents, so an interval
+    # (Euler tour) encoding of a tree cannot be used.
+
+    def __init__(self, ids, names, child_ptr, child_idx, ancestors):
+        self.ids = ids
+        self.names = names
+        self.child_ptr = child_ptr
+        self.child_idx = child_idx
+        self.ancestors = ancestors
+
+        # Map both mids and class names to integer ids
+        self.index = {mid: i for i, mid in enumerate(ids)}
+        self.index.update({name: i for i, name in enumerate(names)})
+
+    @classmethod
+    def load(cls, ontology_path, cache_path=None):
+        with open(ontology_path, 'rb') as f:
+            data = f.read()
+        digest = hashlib.sha256(data).hexdigest()
+
+        # Use the compiled index if it is up to date
+        if cache_path is not None and os.path.exists(cache_path):
+            with np.load(cache_path) as arrays:
+                if str(arrays['digest']) == digest:
+                    n = len(arrays['ids'])
+                    ancestors = np.unpackbits(arrays['ancestors'], axis=1,
+                                              count=n).astype(bool)
+                    return cls(arrays['ids'], arrays['names'],
+                               arrays['child_ptr'], arrays['child_idx'],
+                               ancestors)
+
+        index = cls.compile(json.loads(data))
+        if cache_path is not None:
+            index.save(cache_path, digest)
+        return index
+
+    @classmethod
+    def compile(cls, items):
+        ids = np.array([item['id'] for item in items])
+        names = np.array([item['name'] for item in items])
+        index = {mid: i for i, mid in enumerate(ids)}
+        children = [[index[mid] for mid in item['child_ids']]
+                    for item in items]
+        child_ptr = np.cumsum([0] + [len(c) for c in children])
+        child_idx = np.array([j for c in children for j in c], dtype=int)
+
+        # Compute the descendants of each class recursively
+        # descendants[i, j] is True if i is an ancestor of j
+        descendants = np.zeros((len(items), len(items)), dtype=bool)
+        visited = np.zeros(len(items), dtype=bool)
+
+        def _visit(i):
+            if visited[i]:
+                return descendants[i]
+            for j in children[i]:
+                descendants[i, j] = True
+                descendants[i] |= _visit(j)
+            visited[i] = True
+            return descendants[i]
+
+        for i in range(len(items)):
+            _visit(i)
+
+        return cls(ids, names, child_ptr, child_idx, descendants)
+
+    def save(self, path, digest):
+        # Write to a temporary file first to avoid partial writes
+        tmp_path = f'{path}.part.npz'
+        np.savez(tmp_path, digest=digest, ids=self.ids, names=self.names,
+                 child_ptr=self.child_ptr, child_idx=self.child_idx,
+                 ancestors=np.packbits(self.ancestors, axis=1))
+        os.replace(tmp_path, path)
+
+    def indices(self, keys):
+        # Convert mids or class names to integer ids
+        keys = np.asarray(keys)
+        indices = [self.index[key] for key in keys.ravel()]
+        return np.array(indices, dtype=int).reshape(keys.shape)
+
+    def is_ancestor(self, keys, other_keys):
+        # Determine whether each class is a strict ancestor of the
+        # corresponding class in other_keys (arrays are broadcast)
+        if not np.issubdtype(np.asarray(keys).dtype, np.integer):
+            keys = self.indices(keys)
+        if not np.issubdtype(np.asarray(other_keys).dtype, np.integer):
+            other_keys = self.indices(other_keys)
+        return self.ancestors[keys, other_keys]
+
+    def child_ids(self, key):
+        i = self.index[key]
+        return list(self.ids[self.child_idx[self.child_ptr[i]:
+                                            self.child_ptr[i + 1]]])
+
+    def name(self, key):
+        return str(self.names[self.index[key]])
+
+    def __len__(self):
+        return len(self.ids)
@@ -0,0 +1,35 @@
+import argparse
+import sys
+from pathlib import Path
+
+
+def pack(args):
+    import utils
+    from audio_archive import write_archive
+
+    # The clips are packed by source rather than by split, as the
+    # splits of ARCA23K and ARCA23K-FSD share many clips (see
+    # utils.SPLIT_SOURCES). Each clip is only packed once.
+    audio_dirs = utils.source_audio_dirs(args.work_dir)
+    output_dir = args.work_dir / 'final/packed'
+    output_dir.mkdir(parents=True, exist_ok=True)
+    for source, fnames in utils.source_fnames(args.work_dir).items():
+        clips = [(fname, audio_dirs[source] / f'{fname}.wav')
+                 for fname in fnames]
+        index = write_archive(clips, output_dir / source, args.workers)
+        n_bytes = index.length.sum() * 2
+        print(f'Packed {len(index)} clips ({n_bytes / 2 ** 30:.2f} GiB) '
+              f'into packed/{source}.pcm')
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=Path, default=Path('_output'),
+                        help='path to workspace directory')
+    parser.add_argument('--workers', type=int, default=8,
+                        help='number of files to read at once')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(pack(parse_args()))
@@ -0,0 +1,229 @@
+import argparse
+import hashlib
+import json
+import os
+import shlex
+import subprocess
+import sys
+import threading
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from pathlib import Path
+
+
+ROOT_DIR = Path(__file__).resolve().parents[1]
+
+
+# Each stage runs the script of the same name. The sources are paths
+# relative to the repository and the inputs and outputs are paths
+# relative to the work directory. Optional stages are only run when
+# they are selected using --stages.
+Stage = namedtuple('Stage', ['name', 'sources', 'inputs', 'outputs',
+                             'optional'], defaults=[False])
+
+STAGES = [
+    Stage('create_fsd50k_subset',
+          sources=['src/create_fsd50k_subset.py', 'src/ontology.py',
+                   'metadata/ontology.json'],
+          inputs=[],
+          outputs=['subset', 'fsd50k']),
+    Stage('query_freesound',
+          sources=['src/query_freesound.py', 'src/extern/freesound.py',
+                   'src/metrics.py', 'src/utils.py'],
+          inputs=[],
+          outputs=['query']),
+    Stage('retrieve',
+          sources=['src/retrieve.py', 'src/retrieval', 'src/ontology.py',
+                   'src/metrics.py', 'src/utils.py',
+                   'metadata/ontology.json'],
+          inputs=['subset', 'query', 'fsd50k'],
+          outputs=['freesound_matches.csv', 'labels.txt']),
+    Stage('download_clips',
+          sources=['src/download_clips.py', 'src/extern/freesound.py',
+                   'src/inventory.py', 'src/metrics.py', 'src/utils.py',
+                   'src/wavfile.py'],
+          inputs=['subset', 'query', 'freesound_matches.csv', 'labels.txt'],
+          outputs=['download_list.csv', 'downloads']),
+    Stage('convert_audio',
+          sources=['src/convert_audio.py', 'src/inventory.py',
+                   'src/metrics.py', 'src/utils.py', 'src/wavfile.py'],
+          inputs=['downloads'],
+          outputs=['audio']),
+    Stage('curate_datasets',
+          sources=['src/curate_datasets.py', 'src/inventory.py',
+                   'src/utils.py', 'src/wavfile.py',
+                   'metadata/fsd50k_mids.csv'],
+          inputs=['subset', 'labels.txt', 'download_list.csv', 'audio'],
+          outputs=['final/ARCA23K.ground_truth',
+                   'final/ARCA23K-FSD.ground_truth']),
+    Stage('pack_audio',
+          sources=['src/pack_audio.py', 'src/audio_archive.py',
+                   'src/wavfile.py', 'src/utils.py'],
+          inputs=['final/ARCA23K.ground_truth',
+                  'final/ARCA23K-FSD.ground_truth', 'audio', 'fsd50k'],
+          outputs=['final/packed'],
+          optional=True),
+    Stage('extract_features',
+          sources=['src/extract_features.py', 'src/features.py',
+                   'src/audio_archive.py', 'src/wavfile.py', 'src/utils.py'],
+          inputs=['final/ARCA23K.ground_truth',
+                  'final/ARCA23K-FSD.ground_truth', 'audio', 'fsd50k'],
+          outputs=['final/features'],
+          optional=True),
+]
+
+
+def main(args):
+    work_dir = args.work_dir.resolve()
+    work_dir.mkdir(parents=True, exist_ok=True)
+    stage_args = dict(parse_stage_args(args.stage_args))
+    stages = select_stages(STAGES, args.stages)
+
+    # Map each output to the stage that produces it
+    producers = {output: stage.name
+                 for stage in STAGES for output in stage.outputs}
+    deps = {stage.name: {producers[path] for path in stage.inputs
+                         if producers.get(path) in stages}
+            for stage in stages.values()}
+
+    state_path = work_dir / 'pipeline.json'
+    state = json.loads(state_path.read_text()) if state_path.exists() else {}
+    lock = threading.Lock()
+
+    def _run(stage, stale):
+        params = stage_args.get(stage.name, [])
+        digest = stage_digest(stage, work_dir, params)
+        if not stale and stage.name not in args.force \
+                and state.get(stage.name) == digest \
+                and all((work_dir / path).exists() for path in stage.outputs):
+            print(f'[{stage.name}] Up to date')
+            return 'skipped'
+
+        print(f'[{stage.name}] Running')
+        if args.dry_run:
+            return 'ran'
+
+        cmd = [sys.executable, f'src/{stage.name}.py',
+               '--work_dir', str(work_dir)] + params
+        if subprocess.run(cmd, cwd=ROOT_DIR).returncode != 0:
+            print(f'[{stage.name}] Failed')
+            return 'failed'
+
+        # Record the digest of the inputs that the outputs were built from
+        with lock:
+            state[stage.name] = digest
+            _write_state(state_path, state)
+        print(f'[{stage.name}] Done')
+        return 'ran'
+
+    # Run each stage once the stages it depends on have completed
+    # Stages that do not depend on each other are run concurrently
+    pending = dict(stages)
+    status = {}
+    with ThreadPoolExecutor(args.jobs) as executor:
+        running = {}
+        while pending or running:
+            for name in list(pending):
+                dep_status = {status.get(dep) for dep in deps[name]}
+                if 'failed' in dep_status:
+                    status[name] = 'failed'
+                    del pending[name]
+                elif None not in dep_status:
+                    # In a dry run, the outputs of the stages that
+                    # would be run are not updated, so their dependent
+                    # stages are assumed to be out of date
+                    stale = args.dry_run and 'ran' in dep_status
+                    future = executor.submit(_run, pending.pop(name), stale)
+                    running[future] = name
+
+            if not running:
+                break
+
+            finished, _ = wait(running, return_when=FIRST_COMPLETED)
+            for future in finished:
+                status[running.pop(future)] = future.result()
+
+    failed = [name for name in stages if status.get(name) == 'failed']
+    if failed:
+        print(f'Failed stages: {", ".join(failed)}')
+        return 1
+
+
+def select_stages(stages, names):
+    if not names:
+        return {stage.name: stage for stage in stages if not stage.optional}
+
+    unknown = set(names) - {stage.name for stage in stages}
+    if unknown:
+        raise ValueError(f'Unknown stages: {", ".join(sorted(unknown))}')
+    return {stage.name: stage for stage in stages if stage.name in names}
+
+
+def stage_digest(stage, work_dir, params):
+    hasher = hashlib.sha256()
+    hasher.update(json.dumps(params).encode())
+    for path in stage.sources:
+        _hash_path(hasher, ROOT_DIR / path, content=True)
+    for path in stage.inputs:
+        # Input directories can contain many large files (e.g. audio),
+        # so their files are identified by path, size and mtime
+        _hash_path(hasher, work_dir / path,
+                   content=not (work_dir / path).is_dir())
+    return hasher.hexdigest()
+
+
+def _hash_path(hasher, path, content):
+    if not path.exists():
+        hasher.update(f'{path.name}:missing'.encode())
+        return
+
+    paths = sorted(path.rglob('*')) if path.is_dir() else [path]
+    for file_path in paths:
+        if not file_path.is_file() or file_path.suffix in ['.part', '.pyc']:
+            continue
+
+        hasher.update(str(file_path.relative_to(path.parent)).encode())
+        if content:
+            with open(file_path, 'rb') as f:
+                for chunk in iter(lambda: f.read(2 ** 20), b''):
+                    hasher.update(chunk)
+        else:
+            stat = file_path.stat()
+            hasher.update(f'{stat.st_size}:{stat.st_mtime_ns}'.encode())
+
+
+def _write_state(state_path, state):
+    tmp_path = state_path.with_name(state_path.name + '.part')
+    with open(tmp_path, 'w') as f:
+        json.dump(state, f, indent=2)
+    os.replace(tmp_path, state_path)
+
+
+def parse_stage_args(values):
+    for value in values:
+        name, _, stage_args = value.partition('=')
+        yield name, shlex.split(stage_args)
+
+
+def parse_args():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--work_dir', type=Path, default=Path('_output'),
+                        help='path to workspace directory')
+    parser.add_argument('--stages', nargs='+', default=[],
+                        help='names of the stages to run (default: all '
+                             'but the optional stages)')
+    parser.add_argument('--force', nargs='+', default=[],
+                        help='names of stages to run even if up to date')
+    parser.add_argument('--stage_args', nargs='+', default=[],
+                        metavar='STAGE=ARGS',
+                        help='extra arguments for a stage, '
+                             'e.g. retrieve="--workers 8"')
+    parser.add_argument('--jobs', type=int, default=2,
+                        help='maximum number of stages to run at once')
+    parser.add_argument('--dry_run', action='store_true',
+                        help='print the stages that would be run')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    sys.exit(main(parse_args()))
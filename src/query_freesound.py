@@ -1,10 +1,28 @@
 import argparse
+import gzip
 import json
+import os
+import random
+import re
+import shutil
 import sys
 import time
+from concurrent.futures import ThreadPoolExecutor
+from datetime import datetime, timezone
 from pathlib import Path
 
-from extern.freesound import FreesoundClient, FreesoundException
+import utils
+from extern.freesound import URIS, FreesoundClient, FreesoundException, \
+    FSRequest, Pager, ResponseCache
+from metrics import METRICS, write_report
+
+
+PAGE_SIZE = 150
+
+# Matches the top-level 'next' field of a page, which is either null or
+# a string. The API places it before the results, near the start of the
+# page, so it can be found without parsing the rest of the page.
+NEXT_PATTERN = re.compile(rb'"next":\s*(null|"(?:[^"\\]|\\.)*")')
 
 
 def download(args):
@@ -13,61 +31,403 @@ def download(args):
 
     client = FreesoundClient()
     client.set_token(params['client_secret'])
+    if args.cache_dir is not None:
+        client.cache = ResponseCache(str(args.cache_dir.expanduser()),
+                                     ttl=args.cache_ttl)
 
-    # Ensure output directory exists
     output_dir = args.work_dir / 'query'
+    if args.delta:
+        sync(client, output_dir, args.work_dir / 'query_delta',
+             args.raw, args.compress)
+    elif args.partitions > 1:
+        partitions_dir = args.work_dir / 'query_partitions'
+        download_partitioned(client, output_dir, partitions_dir,
+                             args.partitions, args.concurrency,
+                             args.start_date, args.raw, args.compress)
+    else:
+        download_pages(client, output_dir, raw=args.raw,
+                       compress=args.compress)
+
+    if args.check_deleted > 0:
+        check_deleted(client, output_dir, args.check_deleted,
+                      args.concurrency)
+
+    write_report(args.work_dir, 'query_freesound', args.metrics_textfile)
+
+
+def download_pages(client, output_dir, filter_='', name='',
+                   raw=False, compress=False):
+    # Ensure output directory exists
     output_dir.mkdir(parents=True, exist_ok=True)
 
     # Determine the first page to start downloading
     # Redownload the last downloaded page in case it has been updated
-    initial_page = sum(1 for _ in output_dir.glob('page*.json')) or 1
+    paths = utils.page_paths(output_dir)
+    initial_page = sum(utils.page_count(path) for path in paths) or 1
 
+    # Cached copies of the redownloaded page and of the last page are
+    # revalidated, as newer pages would be missed if they were stale
     page = initial_page
+    revalidate = True
     while True:
-        response = text_search(client, page)
-        output_path = output_dir / f'page{page:04d}.json'
-        with open(output_path, 'w') as f:
-            json.dump(response.json_dict, f, indent=2)
+        output_path = output_dir / page_name(page, compress)
+        if raw:
+            # Save the response as is instead of decoding it
+            response = text_search(client, page, filter_=filter_, raw=True,
+                                   revalidate=revalidate)
+            next_page = save_page(response, output_path, compress)
+            print(f'{name}Page {page} retrieved')
+        else:
+            response = text_search(client, page, filter_=filter_,
+                                   revalidate=revalidate)
+            with utils.open_page(output_path, 'w') as f:
+                json.dump(response.json_dict, f, indent=2)
+            next_page = response.next
+
+            METRICS.inc('query.results', len(response.results))
+            print(f'{name}Page {page} retrieved '
+                  f'with {len(response.results)} results')
 
-        print(f'Page {page} retrieved with {len(response.results)} results')
+        METRICS.inc('query.pages')
 
-        if response.next is None:
+        # Remove the page if it was saved in the other format before
+        other_path = output_dir / page_name(page, not compress)
+        if other_path.exists():
+            other_path.unlink()
+
+        if next_page is None:
+            if client.cache is not None and not revalidate:
+                revalidate = True
+                continue
             break
 
         page += 1
+        revalidate = False
 
     if page > initial_page:
-        print(f'Retrieved pages {initial_page}-{page}')
+        print(f'{name}Retrieved pages {initial_page}-{page}')
+
+
+def page_name(page, compress=False):
+    return f'page{page:04d}.json' + ('.gz' if compress else '')
+
+
+def save_page(response, output_path, compress=False, chunk_size=2 ** 16):
+    # Stream the response to disk and return the URL of the next page
+    # Pages are written to a temporary file first so that a partially
+    # written page is never mistaken for a complete one
+    tmp_path = output_path.with_name(output_path.name + '.part')
+    if compress:
+        f = gzip.open(tmp_path, 'wb', compresslevel=6)
+    else:
+        f = open(tmp_path, 'wb')
+
+    head = tail = b''
+    with f, response:
+        for chunk in iter(lambda: response.read(chunk_size), b''):
+            f.write(chunk)
+            METRICS.inc('query.bytes', len(chunk))
+            if len(head) < chunk_size:
+                head += chunk
+            tail = tail[-chunk_size:] + chunk
+    os.replace(tmp_path, output_path)
+
+    match = NEXT_PATTERN.search(head) or NEXT_PATTERN.search(tail)
+    if match is not None:
+        return json.loads(match.group(1))
+
+    # Fall back to parsing the entire page
+    with utils.open_page(output_path) as f:
+        return json.load(f)['next']
+
+
+def download_partitioned(client, output_dir, partitions_dir,
+                         n_partitions, concurrency, start_date,
+                         raw=False, compress=False):
+    partitions = load_partitions(partitions_dir, n_partitions, start_date)
+
+    # Download the pages of each partition concurrently
+    # Each partition is resumed independently of the others
+    def _download(i):
+        start, end = partitions[i]
+        filter_ = f'created:[{start} TO {end}]'
+        download_pages(client, partitions_dir / f'part{i:03d}',
+                       filter_=filter_, name=f'[Partition {i}] ',
+                       raw=raw, compress=compress)
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        list(executor.map(_download, range(len(partitions))))
+
+    merge_partitions(partitions_dir, len(partitions), output_dir, compress)
+
+
+def load_partitions(partitions_dir, n_partitions, start_date):
+    # Reuse the partitions of a previous run so that it can be resumed
+    spec_path = partitions_dir / 'partitions.json'
+    if spec_path.exists():
+        with open(spec_path, 'r') as f:
+            spec = json.load(f)
+        # Specs written by older versions are a list of the partitions
+        if isinstance(spec, list):
+            spec = {'partitions': spec, 'n_partitions': len(spec)}
+        if spec['n_partitions'] != n_partitions \
+                or spec.get('start_date', start_date) != start_date:
+            raise ValueError(
+                f'{spec_path} was created with --partitions '
+                f'{spec["n_partitions"]} --start_date '
+                f'{spec.get("start_date", "?")}. Use the same values to '
+                f'resume, or delete {partitions_dir} to start over.')
+        return spec['partitions']
+
+    # Split the time between start_date and now into date ranges
+    # The final range is open-ended to include new uploads
+    start = datetime.fromisoformat(start_date).replace(tzinfo=timezone.utc)
+    step = (datetime.now(timezone.utc) - start) / n_partitions
+    bounds = [(start + step * i).strftime('%Y-%m-%dT%H:%M:%SZ')
+              for i in range(n_partitions)]
+    partitions = list(zip(['*'] + bounds[1:], bounds[1:] + ['*']))
 
+    partitions_dir.mkdir(parents=True, exist_ok=True)
+    spec = {
+        'n_partitions': n_partitions,
+        'start_date': start_date,
+        'partitions': partitions,
+    }
+    with open(spec_path, 'w') as f:
+        json.dump(spec, f, indent=2)
 
-def text_search(client, page, query=''):
-    fields = 'id,name,tags,description,type,channels,channels,' \
-             'bitdepth,duration,samplerate,license,username'
+    return partitions
 
+
+def merge_partitions(partitions_dir, n_partitions, output_dir,
+                     compress=False):
+    # Partitions are disjoint date ranges sorted in ascending order and
+    # each partition is sorted by creation date, so concatenating them
+    # gives results that are sorted by creation date. Sounds created at
+    # the boundary of two partitions are returned by both, so they are
+    # removed after their first occurrence.
+    results = {}
+    for i in range(n_partitions):
+        for path in utils.page_paths(partitions_dir / f'part{i:03d}'):
+            for entry in utils.read_results(path):
+                results.setdefault(entry['id'], entry)
+    results = list(results.values())
+
+    # Write the pages to a temporary directory and then swap it with the
+    # output directory, so that the results of a previous merge are not
+    # lost if this one is interrupted
+    tmp_dir = output_dir.with_name(output_dir.name + '.part')
+    old_dir = output_dir.with_name(output_dir.name + '.old')
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    tmp_dir.mkdir(parents=True)
+    n_pages = write_pages(tmp_dir, results, compress=compress)
+
+    if output_dir.exists():
+        shutil.rmtree(old_dir, ignore_errors=True)
+        os.replace(output_dir, old_dir)
+    os.replace(tmp_dir, output_dir)
+    shutil.rmtree(old_dir, ignore_errors=True)
+
+    print(f'Merged {len(results)} results into {n_pages} pages')
+
+
+def write_pages(output_dir, results, first_page=1, compress=False):
+    # Split the results into pages numbered from first_page onwards
+    n_pages = max(1, -(-len(results) // PAGE_SIZE))
+    last_page = first_page + n_pages - 1
+    for i in range(n_pages):
+        page = first_page + i
+        json_dict = {
+            'count': len(results),
+            'next': page_name(page + 1, compress)
+            if page < last_page else None,
+            'previous': page_name(page - 1, compress) if page > 1 else None,
+            'results': results[i * PAGE_SIZE:(i + 1) * PAGE_SIZE],
+        }
+        with utils.open_page(output_dir / page_name(page, compress), 'w') as f:
+            json.dump(json_dict, f, indent=2)
+
+    return n_pages
+
+
+def sync(client, output_dir, delta_dir, raw=False, compress=False):
+    # Only fetch the sounds created since the newest sound in the
+    # existing results. The results are sorted by creation date, so the
+    # new sounds can be appended as new pages without having to fetch
+    # the existing pages again, whose boundaries may have shifted.
+    newest, newest_ids = newest_sounds(output_dir)
+    filter_ = f'created:[{newest}Z TO *]'
+
+    # The pages of an interrupted sync are only resumed if they were
+    # fetched using the same filter. Otherwise, e.g. if the sync was
+    # interrupted after the pages were merged, they are removed.
+    spec_path = delta_dir / 'delta.json'
+    spec = {}
+    if spec_path.exists():
+        with open(spec_path, 'r') as f:
+            spec = json.load(f)
+    if spec.get('filter') != filter_:
+        for path in utils.page_paths(delta_dir):
+            path.unlink()
+        delta_dir.mkdir(parents=True, exist_ok=True)
+        with open(spec_path, 'w') as f:
+            json.dump({'filter': filter_}, f, indent=2)
+
+    print(f'Fetching sounds created since {newest} '
+          f'(id {max(newest_ids)})')
+    download_pages(client, delta_dir, filter_=filter_,
+                   name='[Delta] ', raw=raw, compress=compress)
+
+    # The date range is inclusive, so sounds created at the same time as
+    # the newest sound are returned again
+    results = {}
+    for path in utils.page_paths(delta_dir):
+        for entry in utils.read_results(path):
+            created = entry['created']
+            if created > newest or (created == newest
+                                    and entry['id'] not in newest_ids):
+                results.setdefault(entry['id'], entry)
+    results = list(results.values())
+
+    if len(results) > 0:
+        paths = utils.page_paths(output_dir)
+        first_page = sum(utils.page_count(path) for path in paths) + 1
+        n_pages = write_pages(output_dir, results, first_page, compress)
+        print(f'Appended {len(results)} new results as pages '
+              f'{first_page}-{first_page + n_pages - 1}')
+    else:
+        print('No new results')
+    METRICS.inc('query.new_results', len(results))
+
+    # The downloaded pages are only removed once they have been merged,
+    # so that an interrupted sync can be resumed
+    for path in utils.page_paths(delta_dir):
+        path.unlink()
+
+
+def newest_sounds(output_dir):
+    # Return the creation date of the newest sound and the ids of the
+    # sounds created at that time. As the results are sorted by creation
+    # date, these sounds are in the last page.
+    paths = utils.page_paths(output_dir)
+    if len(paths) == 0:
+        raise FileNotFoundError(f'No results found in {output_dir}')
+    entries = list(utils.read_results(paths[-1]))
+    if len(entries) == 0 or 'created' not in entries[-1]:
+        raise ValueError(f'{paths[-1].name} does not have creation dates; '
+                         'the results must be fetched again in full')
+    newest = max(entry['created'] for entry in entries)
+    return newest, {entry['id'] for entry in entries
+                    if entry['created'] == newest}
+
+
+def check_deleted(client, output_dir, n_checks, concurrency, seed=None):
+    # Sounds may be deleted from Freesound after they have been fetched,
+    # which is only noticed by requesting them. A random sample of the
+    # sounds are requested and those that no longer exist are recorded
+    # in deleted.txt, so that they are excluded when loading the results.
+    deleted = utils.read_deleted(output_dir)
+    ids = [entry['id'] for path in utils.page_paths(output_dir)
+           for entry in utils.read_results(path)
+           if entry['id'] not in deleted]
+    sample = random.Random(seed).sample(ids, min(n_checks, len(ids)))
+
+    # The requests are revalidated, as a cached response would hide that
+    # the sound has since been deleted
+    def _is_deleted(sound_id):
+        uri = URIS.uri(URIS.SOUND, sound_id)
+        try:
+            FSRequest.request(uri, {'fields': 'id'}, client, revalidate=True)
+        except FreesoundException as e:
+            if e.code == 404:
+                return True
+            raise e
+        return False
+
+    with ThreadPoolExecutor(concurrency) as executor:
+        found = [sound_id for sound_id, is_deleted
+                 in zip(sample, executor.map(_is_deleted, sample))
+                 if is_deleted]
+
+    with open(output_dir / 'deleted.txt', 'a') as f:
+        for sound_id in found:
+            f.write(f'{sound_id}\n')
+
+    METRICS.inc('query.deleted', len(found))
+    rate = len(found) / max(1, len(sample))
+    print(f'{len(found)} of {len(sample)} sampled sounds have been deleted '
+          f'(approx. {rate * len(ids):.0f} of {len(ids)} in total)')
+
+
+def text_search(client, page, query='', filter_='', raw=False,
+                revalidate=False):
+    params = {
+        'query': query,
+        'fields': ','.join(utils.QUERY_FIELDS),
+        'filter': f'duration:[* TO 30] {filter_}'.strip(),
+        'sort': 'created_asc',
+        'page': str(page),
+        'page_size': PAGE_SIZE,
+    }
+
+    uri = URIS.uri(URIS.TEXT_SEARCH)
+    start = time.perf_counter()
     try:
-        return client.text_search(
-            query=query,
-            fields=fields,
-            filter='duration:[* TO 30]',
-            sort='created_asc',
-            page=str(page),
-            page_size=150,
-        )
+        if raw:
+            # Return the unread response so that it can be streamed
+            response = FSRequest.open(uri, params, client,
+                                      revalidate=revalidate)
+        else:
+            response = FSRequest.request(uri, params, client, Pager,
+                                         revalidate=revalidate)
     except FreesoundException as e:
+        METRICS.observe('query.http_latency_seconds',
+                        time.perf_counter() - start)
+        METRICS.inc('query.http_errors', code=e.code)
         if e.code == 500:
             # Search server could not be reached
             # Wait 10 seconds before trying again
             time.sleep(10)
 
-            return text_search(client, page, query)
+            return text_search(client, page, query, filter_, raw, revalidate)
 
         raise e
 
+    METRICS.observe('query.http_latency_seconds', time.perf_counter() - start)
+    return response
+
 
 def parse_args():
     parser = argparse.ArgumentParser()
     parser.add_argument('--work_dir', type=Path, default=Path('_output'),
                         help='path to workspace directory')
+    parser.add_argument('--partitions', type=int, default=1,
+                        help='number of date ranges to split the search into')
+    parser.add_argument('--concurrency', type=int, default=4,
+                        help='maximum number of partitions to fetch at once')
+    parser.add_argument('--start_date', default='2005-01-01',
+                        help='start of the first date range (ISO 8601)')
+    parser.add_argument('--delta', action='store_true',
+                        help='only fetch sounds created since the newest '
+                             'sound in the existing results')
+    parser.add_argument('--check_deleted', type=int, default=0,
+                        metavar='N',
+                        help='number of sounds to request to check whether '
+                             'they have been deleted')
+    parser.add_argument('--raw', action='store_true',
+                        help='save responses without decoding them')
+    parser.add_argument('--compress', action='store_true',
+                        help='save pages as gzip-compressed files')
+    parser.add_argument('--cache_dir', type=Path,
+                        help='path to a directory for caching responses, '
+                             'e.g. ~/.cache/freesound')
+    parser.add_argument('--cache_ttl', type=float, default=86400,
+                        help='number of seconds before a cached response '
+                             'is revalidated')
+    parser.add_argument('--metrics_textfile', type=Path,
+                        help='path to a Prometheus textfile to export '
+                             'metrics to, which is overwritten, so each '
+                             'script needs its own file')
     return parser.parse_args()
 
 
@@ -1,25 +1,245 @@
+import json
+import os
+import re
+import time
+from collections import OrderedDict
+from functools import lru_cache
+
 import nltk
 from nltk.corpus import stopwords, wordnet
 
 
 STOP_WORDS = stopwords.words('english')
 
+# The patterns below mimic how word_tokenize splits text, but only as far
+# as is needed to find the tokens that is_word accepts (see tokenize_words)
+
+# Characters and sequences that are always split from adjacent text
+SEPARATORS = re.compile(r'(\s+|\'\'|--|\.{2,}|[:,](?!\d)'
+                        r'|["`«“‘„»”’;@#$%&?!*()\[\]{}<>\u2012-\u2015])')
+
+# A quote at the start of a word unless it begins a contraction
+LEADING_QUOTE = re.compile(r"(?<!\w)'(?!(?:re|ve|ll|m|t|s|d|n)\b)(?=\w)", re.I)
+
+# Contraction suffixes that are split from the end of a token, in order
+CLITICS = [re.compile(r"(?<=[^' ])('[sSmMdD]|')$"),
+           re.compile(r"(?<=[^' ])('ll|'LL|'re|'RE|'ve|'VE|n't|N'T)$")]
+
+# Words that are split in two e.g. 'cannot' becomes 'can not'
+CONTRACTIONS = re.compile(r"(?i)\b(can)(not)\b|\b(d)('ye)\b|\b(gim)(me)\b"
+                          r"|\b(gon)(na)\b|\b(got)(ta)\b|\b(lem)(me)\b"
+                          r"|\b(more)('n)\b|\b(wan)(na)$")
+CONTRACTED_WORDS = {'cannot', 'gimme', 'gonna', 'gotta', 'lemme', 'wanna'}
+
+# Characters after which a period may end a sentence (Punkt)
+SENTENCE_END_CONTEXT = tuple('?!)";}]*:@\'({[‘’“”«»')
+
+# What may follow the period at the end of the text for it to be split,
+# unless it contains a quote that word_tokenize treats as an opening quote
+FINAL_PERIOD_CONTEXT = re.compile(r'[\]\)}>"\'»”’\s]*')
+OPENING_QUOTE = re.compile(r'\s(?:"|\'\')')
+
+# Closing punctuation that Punkt moves from the start of a sentence to
+# the end of the previous sentence
+REALIGNED = re.compile(r'\s*["\')\]}]+?(?:\s+|(?=--)|$)')
+
+# A period, question mark, or exclamation mark later in the same word
+# that may end a sentence
+LATER_END = re.compile(r'\S*[.?!](?=[?!)";}\]*:@\'({\[‘’“”«»]|\s+\S)')
+
+# A next token that ends with a period and is followed by punctuation
+NEXT_PERIOD = re.compile(r'\s+([^\s)";}\]*:@\'({\[!?,]+)\.'
+                         r'(?=[)";}\]*:@\'({\[!?,]|--)')
+
+# Tokens after which an initial does not end a sentence (Punkt)
+INITIAL_FOLLOWERS = re.compile(r'[;:,!?]|\.(?!\.|\s\.\s\.)')
+
 
 class ShortestLemmatizer:
-    def __init__(self, lemmatizer):
+    def __init__(self, lemmatizer, cache_size=2 ** 20):
         self.lemmatizer = lemmatizer
+        self.cache_size = cache_size
+        self.cache = OrderedDict()
+
+        # Worker processes record the lemmas they compute so that these
+        # can be sent back to the parent process (see pop_new_lemmas)
+        self.track_new = False
+        self.new_lemmas = {}
+
+        # Statistics for instrumentation
+        self.n_tokens = 0
+        self.n_misses = 0
+        self.wordnet_seconds = 0.0
 
     def lemmatize(self, token):
+        self.n_tokens += 1
+        lemma = self.cache.get(token)
+        if lemma is not None:
+            self.cache.move_to_end(token)
+            return lemma
+
+        start = time.perf_counter()
         words = [self.lemmatizer.lemmatize(token, pos)
                  for pos in [wordnet.ADJ, wordnet.NOUN,
                              wordnet.VERB, wordnet.ADV]]
-        return min(words, key=len)
+        lemma = min(words, key=len)
+        self.wordnet_seconds += time.perf_counter() - start
+        self.n_misses += 1
+        if self.track_new:
+            self.new_lemmas[token] = lemma
+        self._insert(token, lemma)
+        return lemma
+
+    def update(self, lemmas):
+        for token, lemma in lemmas.items():
+            self._insert(token, lemma)
+
+    def pop_new_lemmas(self):
+        # Return the lemmas computed since the last call
+        lemmas, self.new_lemmas = self.new_lemmas, {}
+        return lemmas
+
+    def load(self, path):
+        # The lemma table is ignored if it was created using a
+        # different version of NLTK or WordNet, or if it is corrupt
+        try:
+            with open(path, 'r') as f:
+                table = json.load(f)
+            if table['version'] != self.version():
+                return False
+            lemmas = dict(table['lemmas'])
+        except FileNotFoundError:
+            return False
+        except (ValueError, KeyError, TypeError):
+            print(f'Ignoring corrupt lemma table: {path}')
+            return False
+
+        self.update(lemmas)
+        return True
+
+    def save(self, path):
+        # Write to a temporary file first, as several processes may
+        # save the table at once (e.g. when running shards)
+        table = {'version': self.version(), 'lemmas': self.cache}
+        tmp_path = f'{path}.{os.getpid()}.part'
+        with open(tmp_path, 'w') as f:
+            json.dump(table, f)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def version():
+        return {'nltk': nltk.__version__, 'wordnet': wordnet.get_version()}
+
+    def _insert(self, token, lemma):
+        self.cache[token] = lemma
+        self.cache.move_to_end(token)
+        if len(self.cache) > self.cache_size:
+            self.cache.popitem(last=False)
 
 
 def tokenize(text):
     return nltk.tokenize.word_tokenize(text.replace('/', ' '))
 
 
+def tokenize_words(text):
+    # A faster alternative to tokenize() followed by filtering with
+    # is_word, as only the word tokens are needed. The separators are
+    # kept in the list of parts, which alternates between the two.
+    abbreviations = punkt_abbreviations()
+    parts = SEPARATORS.split(text.replace('/', ' '))
+    last = max((i for i in range(0, len(parts), 2) if parts[i].strip("'")),
+               default=0)
+
+    words = []
+    for i in range(0, len(parts), 2):
+        token = parts[i]
+        if token.isalpha() and token.lower() not in CONTRACTED_WORDS:
+            words.append(token)
+            continue
+        if not token:
+            continue
+
+        # A period that ends a sentence is split from the token, along
+        # with a quote that follows it. The end of the sentence must also
+        # be the end of the text as far as word_tokenize is concerned.
+        following = ''.join(parts[i + 1:] if i == last else parts[i + 1:i + 6])
+        if token.endswith(".'"):
+            token, following = token[:-1], "'" + following
+        if token.endswith('.') and (
+                i == last and _ends_text(following)
+                or _ends_sentence(token, following, abbreviations)
+                and _ends_text(_sentence_tail(following))):
+            token = token[:-1]
+
+        for part in LEADING_QUOTE.sub("' ", token).split():
+            for pattern in CLITICS:
+                part = pattern.sub('', part)
+            if CONTRACTIONS.search(part):
+                part = CONTRACTIONS.sub(_split_contraction, part)
+                words += [word for word in part.split() if is_word(word)]
+            elif is_word(part):
+                words.append(part)
+
+    return words
+
+
+def _ends_text(following):
+    return FINAL_PERIOD_CONTEXT.fullmatch(following) is not None \
+        and OPENING_QUOTE.search(following) is None
+
+
+def _sentence_tail(following):
+    # Return the text that follows the period in its sentence
+    match = REALIGNED.match(following)
+    return match.group() if match is not None else ''
+
+
+def _ends_sentence(token, following, abbreviations):
+    # The period must be followed by whitespace or punctuation. Punkt
+    # only considers the last period, question mark, or exclamation mark
+    # of a sequence without whitespace, e.g. the '?' of 'etc.?'
+    if not following.startswith(SENTENCE_END_CONTEXT) \
+            and not following[0].isspace() or LATER_END.match(following):
+        return False
+    if _is_sentence_end(token[:-1].lower(), following, abbreviations):
+        return True
+
+    # Punkt looks at the next token too, so the sentence also ends here
+    # if the next token ends a sentence and is followed by punctuation
+    match = NEXT_PERIOD.match(following)
+    return match is not None and _is_sentence_end(
+        match.group(1).lower(), following[match.end():], abbreviations)
+
+
+def _is_sentence_end(prefix, following, abbreviations):
+    # Punkt ends a sentence at a period unless the period follows an
+    # abbreviation, or an initial that is followed by a word or by
+    # punctuation such as a colon. Its orthographic heuristics, which
+    # are based on the next word and can overrule this, are only partly
+    # replicated.
+    if len(prefix) == 1 and prefix.isalpha():
+        following = following.lstrip()
+        return not (following[:1].isalpha()
+                    or INITIAL_FOLLOWERS.match(following))
+    return prefix not in abbreviations \
+        and prefix.split('-')[-1] not in abbreviations
+
+
+def _split_contraction(match):
+    groups = [group for group in match.groups() if group]
+    return f' {groups[0]} {groups[1]} '
+
+
+@lru_cache(maxsize=None)
+def punkt_abbreviations(language='english'):
+    # The abbreviations after which Punkt does not end a sentence
+    tokenizer = nltk.data.load(f'tokenizers/punkt/{language}.pickle')
+    return frozenset(tokenizer._params.abbrev_types)
+
+
+TOKENIZERS = {'nltk': tokenize, 'regex': tokenize_words}
+
+
 def preprocess(tokens, lemmatizer=None):
     # Filter out tokens that are not words e.g. punctuation
     tokens = filter(is_word, tokens)
@@ -48,3 +268,9 @@ def smart_lowercase(word):
 
 def is_word(text):
     return str.isalpha(text.replace('-', ''))
+
+
+def compare_tokenizers(text):
+    # Return the terms given by tokenize and by tokenize_words, which
+    # should be the same
+    return preprocess(tokenize(text)), preprocess(tokenize_words(text))
@@ -1,7 +1,11 @@
+import time
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
+from metrics import METRICS
 from . import preprocessing
 
 
@@ -22,28 +26,57 @@ class Vocabulary:
             orig_labels[label] = orig_label
 
             # Extract terms from child labels
-            ids = ontology[label].child_ids
+            ids = ontology.child_ids(label)
             for child_id in ids:
-                child_label = ontology[child_id].name
+                child_label = ontology.name(child_id)
                 terms = extract_label_terms(child_label, lemmatizer)
                 vocabulary += terms
                 label_terms[child_label] = terms
                 orig_labels[child_label] = orig_label
 
         self.vocabulary = sorted(set(vocabulary))
+        self.term_index = {term: i for i, term in enumerate(self.vocabulary)}
         self.label_vecs = self.vectorize(label_terms)
+        self.label_norms = np.linalg.norm(self.label_vecs, axis=1)
         self.orig_labels = list(orig_labels.values())
 
+        # Create an inverted index that maps each term (column) to the
+        # labels (rows of label_vecs) that contain the term
+        self.term_labels = [np.flatnonzero(col) for col in self.label_vecs.T]
+
     def vectorize(self, terms):
         if isinstance(terms, dict):
             label_vecs = {label: self.vectorize(term_list)
                           for label, term_list in terms.items()}
             return np.stack(list(label_vecs.values()))
 
-        return np.isin(self.vocabulary, terms).astype(float)
+        vec = np.zeros(len(self))
+        vec[self.columns(terms)] = 1
+        return vec
+
+    def columns(self, terms):
+        # Determine the column indices of the terms in the vocabulary
+        # Terms that are not in the vocabulary are ignored
+        indices = [self.term_index.get(term) for term in terms]
+        indices = dict.fromkeys(i for i in indices if i is not None)
+        return np.fromiter(indices, dtype=int, count=len(indices))
 
     def match(self, vec):
-        sim = cosine_similarity(vec, self.label_vecs)
+        cols = np.flatnonzero(vec)
+        return self.match_columns(cols, vec[cols])
+
+    def match_columns(self, cols, counts):
+        # Only the labels that share a term with the clip can have a
+        # non-zero similarity, so the other labels are not scored
+        sim = np.zeros(len(self.label_vecs))
+        if len(cols) > 0:
+            rows = np.unique(np.concatenate([self.term_labels[col]
+                                             for col in cols]))
+            counts = np.asarray(counts, dtype=float)
+            norm = np.linalg.norm(counts) * self.label_norms[rows]
+            sim[rows] = self.label_vecs[np.ix_(rows, cols)] @ counts
+            sim[rows] /= norm + 1e-8
+
         index = np.argmax(sim)
         label = self.orig_labels[index]
         return sim, index, label
@@ -52,24 +85,34 @@ class Vocabulary:
         return len(self.vocabulary)
 
 
-def retrieve(entries, vocab, lemmatizer, threshold=0.5):
-    results = {}
-    for clip_id, entry in tqdm(entries.iterrows(), total=len(entries)):
-        # Preprocess tags to simplify retrieval
-        tags = preprocessing.preprocess(entry.tags, lemmatizer)
+def retrieve(entries, vocab, lemmatizer, threshold=0.5, batch_size=0,
+             workers=1, tokenizer='nltk'):
+    # Preprocess tags and descriptions of all entries
+    tokenize = preprocessing.TOKENIZERS[tokenizer]
+    entry_terms = preprocess_entries(entries, lemmatizer, workers, tokenize)
 
-        # Tokenize and preprocess clip description
-        desc_tokens = preprocessing.tokenize(entry.description)
-        desc_terms = preprocessing.preprocess(desc_tokens, lemmatizer)
+    with METRICS.timer('retrieve.match'):
+        if batch_size > 0:
+            results = retrieve_batched(entries.index, entry_terms, vocab,
+                                       threshold, batch_size)
+        else:
+            results = _retrieve(entries.index, entry_terms, vocab,
+                                threshold)
+
+    METRICS.inc('retrieve.clips', len(entries))
+    METRICS.inc('retrieve.clips_matched', len(results))
+    return results
 
-        # Vectorize query and description
-        vec = np.zeros(len(vocab))
-        if len(tags) > 0:
-            vec += vocab.vectorize(tags)
-        if len(desc_terms) > 0:
-            vec += vocab.vectorize(desc_terms)
 
-        sim, index, label = vocab.match(vec)
+def _retrieve(clip_ids, entry_terms, vocab, threshold):
+    results = {}
+    for clip_id, (tags, desc_terms) in zip(clip_ids, entry_terms):
+        # Vectorize query and description as a list of term counts
+        cols = np.concatenate([vocab.columns(tags),
+                               vocab.columns(desc_terms)])
+        cols, counts = np.unique(cols, return_counts=True)
+
+        sim, index, label = vocab.match_columns(cols, counts)
         if sim[index] > threshold:
             results[clip_id] = (label, sim[index])
 
@@ -80,6 +123,152 @@ def retrieve(entries, vocab, lemmatizer, threshold=0.5):
     return results
 
 
+def retrieve_batched(clip_ids, entry_terms, vocab, threshold=0.5,
+                     batch_size=4096):
+    # Build a sparse clip-by-term matrix in coordinate format
+    rows, cols = [], []
+    for row, (tags, desc_terms) in enumerate(entry_terms):
+        for terms in [tags, desc_terms]:
+            if len(terms) > 0:
+                indices = vocab.columns(terms)
+                rows.append(np.full(len(indices), row))
+                cols.append(indices)
+
+    rows = np.concatenate(rows or [np.empty(0, dtype=int)])
+    cols = np.concatenate(cols or [np.empty(0, dtype=int)])
+    bounds = np.searchsorted(rows, np.arange(0, len(clip_ids), batch_size))
+    bounds = np.append(bounds, len(rows))
+
+    # Score the clips against the labels one batch of rows at a time
+    results = {}
+    for i, start in enumerate(range(0, len(clip_ids), batch_size)):
+        size = min(batch_size, len(clip_ids) - start)
+        batch = slice(bounds[i], bounds[i + 1])
+        vecs = np.zeros((size, len(vocab)))
+        np.add.at(vecs, (rows[batch] - start, cols[batch]), 1)
+
+        sim = batch_cosine_similarity(vecs, vocab.label_vecs)
+        indices = np.argmax(sim, axis=1)
+        scores = sim[np.arange(size), indices]
+        for j in np.flatnonzero(scores > threshold):
+            label = vocab.orig_labels[indices[j]]
+            results[clip_ids[start + j]] = (label, scores[j])
+
+    # Create a DataFrame object for the results
+    columns = ['prediction', 'score']
+    results = pd.DataFrame.from_dict(results, orient='index', columns=columns)
+
+    return results
+
+
+def preprocess_entries(entries, lemmatizer, workers=1,
+                       tokenize=preprocessing.tokenize, chunk_size=1000):
+    tags = entries.tags.tolist()
+    descriptions = entries.description.tolist()
+    if workers <= 1:
+        return _preprocess(tags, descriptions, lemmatizer, tokenize)
+
+    # Split the entries into chunks and preprocess them in parallel
+    # Each worker process receives its own copy of the lemmatizer
+    starts = range(0, len(entries), chunk_size)
+    tag_chunks = [tags[i:i + chunk_size] for i in starts]
+    desc_chunks = [descriptions[i:i + chunk_size] for i in starts]
+    entry_terms = []
+    with ProcessPoolExecutor(workers, initializer=_init_worker,
+                             initargs=(lemmatizer, tokenize)) as executor:
+        chunks = executor.map(_preprocess_chunk, tag_chunks, desc_chunks)
+        with tqdm(total=len(entries)) as pbar:
+            for chunk_terms, lemmas, metrics in chunks:
+                entry_terms += chunk_terms
+                pbar.update(len(chunk_terms))
+                METRICS.merge(metrics)
+
+                # Keep the lemmas computed by the workers
+                if lemmas:
+                    lemmatizer.update(lemmas)
+
+    return entry_terms
+
+
+def _preprocess(tags, descriptions, lemmatizer,
+                tokenize=preprocessing.tokenize, progress=True):
+    stats = _lemmatizer_stats(lemmatizer)
+    n_tokens = 0
+    tokenize_time = preprocess_time = 0.0
+
+    entry_terms = []
+    for tag_list, description in tqdm(zip(tags, descriptions),
+                                      total=len(tags), disable=not progress):
+        # Preprocess tags to simplify retrieval
+        start = time.perf_counter()
+        tag_terms = preprocessing.preprocess(tag_list, lemmatizer)
+
+        # Tokenize and preprocess clip description
+        tokenize_start = time.perf_counter()
+        desc_tokens = tokenize(description)
+        tokenize_end = time.perf_counter()
+        desc_terms = preprocessing.preprocess(desc_tokens, lemmatizer)
+
+        entry_terms.append((tag_terms, desc_terms))
+
+        n_tokens += len(tag_list) + len(desc_tokens)
+        tokenize_time += tokenize_end - tokenize_start
+        preprocess_time += time.perf_counter() - tokenize_end \
+            + tokenize_start - start
+
+    METRICS.inc('retrieve.tokens', n_tokens)
+    METRICS.add_time('retrieve.tokenize', tokenize_time, len(tags))
+    METRICS.add_time('retrieve.preprocess', preprocess_time, len(tags))
+    if stats is not None:
+        n_lemmatized, n_misses, seconds = (
+            new - old for new, old in zip(_lemmatizer_stats(lemmatizer),
+                                          stats))
+        METRICS.inc('retrieve.tokens_lemmatized', n_lemmatized)
+        METRICS.add_time('retrieve.wordnet', seconds, n_misses)
+
+    return entry_terms
+
+
+def _lemmatizer_stats(lemmatizer):
+    if not hasattr(lemmatizer, 'n_tokens'):
+        return None
+    return (lemmatizer.n_tokens, lemmatizer.n_misses,
+            lemmatizer.wordnet_seconds)
+
+
+_worker_lemmatizer = None
+_worker_tokenize = None
+
+
+def _init_worker(lemmatizer, tokenize):
+    global _worker_lemmatizer, _worker_tokenize
+    _worker_lemmatizer = lemmatizer
+    _worker_tokenize = tokenize
+
+    # Discard metrics inherited from the parent process
+    METRICS.reset()
+
+    # Keep the lemmas computed by this worker for the parent process
+    if hasattr(lemmatizer, 'track_new'):
+        lemmatizer.track_new = True
+
+    # Load the NLTK resources once per worker rather than per chunk
+    tokenize('Loading resources.')
+    if lemmatizer is not None:
+        lemmatizer.lemmatize('resources')
+
+
+def _preprocess_chunk(tags, descriptions):
+    entry_terms = _preprocess(tags, descriptions, _worker_lemmatizer,
+                              _worker_tokenize, progress=False)
+
+    lemmas = None
+    if hasattr(_worker_lemmatizer, 'pop_new_lemmas'):
+        lemmas = _worker_lemmatizer.pop_new_lemmas()
+
+    return entry_terms, lemmas, METRICS.collect()
+
+
 def extract_label_terms(label, lemmatizer):
     tokens = preprocessing.tokenize(label)
     return preprocessing.preprocess(tokens, lemmatizer)
@@ -90,6 +279,13 @@ def cosine_similarity(vec, other_vecs):
     return np.inner(vec, other_vecs) / (norm + 1e-8)
 
 
+def batch_cosine_similarity(vecs, other_vecs):
+    # Equivalent to calling cosine_similarity() for each row of vecs
+    vec_norms = np.sqrt(np.einsum('ij,ij->i', vecs, vecs))
+    norm = vec_norms[:, None] * np.linalg.norm(other_vecs, axis=1)
+    return np.inner(vecs, other_vecs) / (norm + 1e-8)
+
+
 def to_audioset_label(label):
     label = label.replace('_', ' ')
     if label == 'Dishes and pots and pans':
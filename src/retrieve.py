@@ -6,13 +6,19 @@ from pathlib import Path
 def main(args):
     import nltk
     import pandas as pd
-    from jaffadata.datasets import AudioSetOntology
     from nltk.stem import WordNetLemmatizer
 
     import retrieval
     import utils
+    from metrics import METRICS, write_report
+    from ontology import OntologyIndex
     from retrieval import ShortestLemmatizer
 
+    # Evaluation needs the matches of every clip, which a shard does not have
+    shard = utils.parse_shard(args.shard) if args.shard else None
+    if shard is not None and args.evaluate:
+        raise ValueError('--evaluate cannot be used with --shard')
+
     # Load metadata for FSD50K subset
     dataset_dir = args.work_dir / 'fsd50k'
     subset = read_metadata(args.work_dir / 'subset')
@@ -24,12 +30,18 @@ def main(args):
 
     # Build vocabulary of relevant terms based on label set
     lemmatizer = ShortestLemmatizer(WordNetLemmatizer())
-    ontology = AudioSetOntology('metadata/ontology.json')
+    lemmatizer.load(args.work_dir / 'lemmas.json')
+    ontology = OntologyIndex.load('metadata/ontology.json',
+                                  args.work_dir / 'ontology.npz')
     label_set = sorted(subset.label.unique())
-    vocab = retrieval.Vocabulary(label_set, ontology, lemmatizer)
+    with METRICS.timer('retrieve.vocabulary'):
+        vocab = retrieval.Vocabulary(label_set, ontology, lemmatizer)
 
     # Load Freesound metadata
-    entries = utils.load_freesound_metadata(args.work_dir / 'query')
+    with METRICS.timer('retrieve.load_metadata'):
+        entries = utils.load_freesound_metadata(
+            args.work_dir / 'query', args.work_dir / 'query.pkl',
+            columns=['tags', 'description'])
     mask = entries.index.isin(subset.index)
     if args.evaluate:
         # Filter out entries that do not belong to FSD50K subset
@@ -41,8 +53,30 @@ def main(args):
         mask = ~(mask | entries.index.isin(index))
         entries = entries[mask]
 
+    if args.verify_tokenizer > 0:
+        verify_tokenizer(args.work_dir, entries, args.verify_tokenizer)
+        return
+
+    # Only process the clips assigned to this shard (if applicable)
+    if shard is not None:
+        entries = entries[utils.shard_mask(entries.index, shard)]
+
     # Run retrieval algorithm
-    results = retrieval.retrieve(entries, vocab, lemmatizer)
+    results = retrieval.retrieve(entries, vocab, lemmatizer,
+                                 batch_size=args.batch_size,
+                                 workers=args.workers,
+                                 tokenizer=args.tokenizer)
+    lemmatizer.save(args.work_dir / 'lemmas.json')
+
+    if shard is not None:
+        # The matches of every shard are needed to determine which
+        # classes to keep, so this is done by merge_shards.py
+        path = utils.shard_path(args.work_dir, 'freesound_matches.csv', shard)
+        path.parent.mkdir(exist_ok=True)
+        results.to_csv(path)
+        write_report(args.work_dir, f'retrieve.{utils.shard_name(shard)}',
+                     args.metrics_textfile)
+        return
 
     if args.evaluate:
         pd.options.display.max_rows = 100
@@ -50,17 +84,23 @@ def main(args):
         scores.to_csv(args.work_dir / 'retrieval_scores.csv')
         print(scores)
     else:
-        # Discard classes that lack a sufficient number of matches
-        sizes = results.groupby('prediction').size()
-        sizes2 = subset[subset.train].groupby('label').size()
-        ratios = sizes / (sizes2 + 3)  # margin=3 for headroom
-        labels = ratios.index[ratios >= 1]
-        results = results[results.prediction.isin(labels)]
+        write_matches(args.work_dir, results, subset)
+
+    write_report(args.work_dir, 'retrieve', args.metrics_textfile)
+
+
+def write_matches(work_dir, results, subset):
+    # Discard classes that lack a sufficient number of matches
+    sizes = results.groupby('prediction').size()
+    sizes2 = subset[subset.train].groupby('label').size()
+    ratios = sizes / (sizes2 + 3)  # margin=3 for headroom
+    labels = ratios.index[ratios >= 1]
+    results = results[results.prediction.isin(labels)]
 
-        # Write matches to CSV file
-        results.to_csv(args.work_dir / 'freesound_matches.csv')
-        with open(args.work_dir / 'labels.txt', 'w') as f:
-            f.write('\n'.join(sorted(labels)))
+    # Write matches to CSV file
+    results.to_csv(work_dir / 'freesound_matches.csv')
+    with open(work_dir / 'labels.txt', 'w') as f:
+        f.write('\n'.join(sorted(labels)))
 
 
 def read_metadata(metadata_dir):
@@ -74,6 +114,28 @@ def read_metadata(metadata_dir):
     return df
 
 
+def verify_tokenizer(work_dir, entries, n_samples):
+    import pandas as pd
+
+    from retrieval.preprocessing import compare_tokenizers
+
+    # Check whether the regex tokenizer gives the same terms as NLTK for
+    # a random sample of the descriptions
+    sample = entries.description.sample(min(n_samples, len(entries)),
+                                        random_state=0)
+    divergent = {}
+    for clip_id, text in sample.items():
+        nltk_terms, regex_terms = compare_tokenizers(text)
+        if nltk_terms != regex_terms:
+            divergent[clip_id] = (' '.join(nltk_terms), ' '.join(regex_terms))
+
+    report = pd.DataFrame.from_dict(divergent, orient='index',
+                                    columns=['nltk', 'regex'])
+    report.rename_axis('id').to_csv(work_dir / 'tokenizer_divergence.csv')
+    print(f'{len(report)} of {len(sample)} descriptions are tokenized '
+          'differently (see tokenizer_divergence.csv)')
+
+
 def evaluate(results, subset):
     import pandas as pd
 
@@ -97,6 +159,25 @@ def parse_args():
                         help='path to workspace directory')
     parser.add_argument('--evaluate', type=bool,
                         help='whether to run in evaluation mode')
+    parser.add_argument('--batch_size', type=int, default=4096,
+                        help='number of clips to score at a time (0 to '
+                             'score clips one by one)')
+    parser.add_argument('--workers', type=int, default=1,
+                        help='number of processes used for preprocessing')
+    parser.add_argument('--tokenizer', choices=['nltk', 'regex'],
+                        default='nltk',
+                        help='how to split descriptions into words')
+    parser.add_argument('--verify_tokenizer', type=int, default=0,
+                        metavar='N',
+                        help='compare the tokenizers on N descriptions '
+                             'instead of running retrieval')
+    parser.add_argument('--shard', metavar='INDEX/COUNT',
+                        help='only process the clips of the given shard, '
+                             'e.g. 0/4 (see merge_shards.py)')
+    parser.add_argument('--metrics_textfile', type=Path,
+                        help='path to a Prometheus textfile to export '
+                             'metrics to, which is overwritten, so each '
+                             'script needs its own file')
     return parser.parse_args()
 
 
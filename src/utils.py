@@ -1,23 +1,229 @@
+import gzip
 import json
+import os
+import re
 
+import numpy as np
 import pandas as pd
 from tqdm import tqdm
 
 
-def load_freesound_metadata(metadata_dir):
-    def _has_tags(entry):
-        return len(entry['tags']) > 0
+# The fields of each sound that are requested from Freesound
+QUERY_FIELDS = ['id', 'name', 'tags', 'description', 'type', 'channels',
+                'bitdepth', 'duration', 'samplerate', 'license', 'username',
+                'created']
+
+
+def load_freesound_metadata(metadata_dir, cache_path=None, columns=None):
+    entries = _load_metadata(metadata_dir, cache_path, columns)
+
+    # Remove the sounds that have since been deleted from Freesound
+    deleted = read_deleted(metadata_dir)
+    if len(deleted) > 0:
+        entries = entries[~entries.index.isin(deleted)]
+    return entries
+
+
+def _load_metadata(metadata_dir, cache_path=None, columns=None):
+    # If columns is given, only those columns are returned, which uses
+    # less memory. The cache always contains all of the columns.
+    paths = page_paths(metadata_dir)
+    if len(paths) == 0:
+        raise FileNotFoundError(f'No query pages found in {metadata_dir} '
+                                '(run query_freesound.py first)')
+    if cache_path is None:
+        entries = _read_pages(paths, columns)
+        return entries.drop(columns='page')
+
+    # Pages that have not been modified since the cache was last
+    # updated are loaded from the cache instead of being parsed again
+    stats = {path.name: _stat(path) for path in paths}
+    entries, cached_stats = _load_cache(cache_path)
+    valid = {name for name, stat in cached_stats.items()
+             if stats.get(name) == stat}
+    if valid == set(cached_stats) == set(stats):
+        return _project(entries, columns)
+
+    frames = []
+    if entries is not None:
+        entries = entries[entries.page.isin(valid)]
+        frames.append(entries.astype({'page': str}))
+
+    # Parse the pages that are new or were modified
+    new_paths = [path for path in paths if path.name not in valid]
+    if len(new_paths) > 0:
+        frames.append(_read_pages(new_paths))
+
+    # Ensure entries are in the same order as the pages
+    entries = pd.concat(frames)
+    order = np.argsort(entries.page.values, kind='stable')
+    entries = entries.iloc[order].astype({'page': 'category'})
+
+    _save_cache(cache_path, entries, stats)
+
+    return _project(entries, columns)
 
-    entries = []
-    for path in tqdm(sorted(metadata_dir.iterdir())):
-        with open(path, 'r') as f:
-            json_dict = json.load(f)
 
-        entries += list(filter(_has_tags, json_dict['results']))
+def _read_pages(paths, columns=None):
+    # The fields needed for filtering the entries are always read
+    if columns is not None:
+        fields = set(columns) | {'id', 'tags', 'duration'}
+
+    entries = []
+    pages = []
+    for path in tqdm(paths):
+        for entry in read_results(path):
+            if len(entry['tags']) == 0:
+                continue
+            if columns is not None:
+                entry = {k: v for k, v in entry.items() if k in fields}
+            entries.append(entry)
+            pages.append(path.name)
 
     # Wrap the entries in a DataFrame object
-    entries = pd.DataFrame(entries).set_index('id')
+    entries = pd.DataFrame(entries)
+    entries['page'] = pages
+    entries = entries.set_index('id')
     # Filter out entries that have a duration outside [0.3, 30]
     entries = entries[(entries.duration >= 0.3) & (entries.duration <= 30)]
 
+    if columns is not None:
+        entries = entries[list(columns) + ['page']]
     return entries
+
+
+def _project(entries, columns):
+    if columns is None:
+        return entries.drop(columns='page')
+    return entries[list(columns)]
+
+
+def parse_shard(value):
+    # Parse a shard of the form INDEX/COUNT, e.g. 0/4
+    match = re.fullmatch(r'(\d+)/(\d+)', value)
+    if match is None or int(match.group(1)) >= int(match.group(2)):
+        raise ValueError(f'Invalid shard: {value}')
+    return int(match.group(1)), int(match.group(2))
+
+
+def shard_mask(ids, shard):
+    # Clips are assigned to shards by hashing their IDs so that each
+    # shard gets a similar number of clips however the IDs are spread
+    index, count = shard
+    h = np.asarray(ids, dtype=np.uint64) * np.uint64(0x9E3779B97F4A7C15)
+    h ^= h >> np.uint64(29)
+    return h % np.uint64(count) == np.uint64(index)
+
+
+def shard_name(shard):
+    index, count = shard
+    return f'{index:03d}-of-{count:03d}'
+
+
+def shard_path(work_dir, name, shard):
+    # Return e.g. shards/inventory.001-of-004.csv for inventory.csv
+    stem, suffix = os.path.splitext(name)
+    return work_dir / 'shards' / f'{stem}.{shard_name(shard)}{suffix}'
+
+
+# Only the ARCA23K training set is sourced from Freesound. The other
+# splits are sourced from FSD50K, and ARCA23K and ARCA23K-FSD share the
+# same validation and test sets.
+SPLIT_SOURCES = {
+    ('ARCA23K', 'train'): 'Freesound',
+    ('ARCA23K', 'val'): 'FSD50K.dev',
+    ('ARCA23K', 'test'): 'FSD50K.eval',
+    ('ARCA23K-FSD', 'train'): 'FSD50K.dev',
+    ('ARCA23K-FSD', 'val'): 'FSD50K.dev',
+    ('ARCA23K-FSD', 'test'): 'FSD50K.eval',
+}
+
+
+def source_audio_dirs(work_dir):
+    fsd50k_dir = work_dir / 'fsd50k'
+    return {
+        'Freesound': work_dir / 'audio',
+        'FSD50K.dev': fsd50k_dir / 'FSD50K.dev_audio',
+        'FSD50K.eval': fsd50k_dir / 'FSD50K.eval_audio',
+    }
+
+
+def split_audio_dirs(work_dir):
+    audio_dirs = source_audio_dirs(work_dir)
+    return {split: audio_dirs[source]
+            for split, source in SPLIT_SOURCES.items()}
+
+
+def source_fnames(work_dir):
+    # Return the file names of the clips of each source that belong to
+    # at least one split, so that shared clips are only listed once
+    fnames = {source: {} for source in source_audio_dirs(work_dir)}
+    for (dataset, split), source in SPLIT_SOURCES.items():
+        path = work_dir / f'final/{dataset}.ground_truth/{split}.csv'
+        index = pd.read_csv(path, index_col=0).index
+        fnames[source].update(dict.fromkeys(index))
+    return {source: list(names) for source, names in fnames.items()}
+
+
+def page_paths(metadata_dir):
+    # Pages are saved as either plain or gzip-compressed JSON files
+    # Compacted pages are saved as NDJSON segments (see compact_query.py)
+    return sorted(path for path in metadata_dir.glob('page*')
+                  if path.name.endswith(('.json', '.json.gz', '.ndjson.gz')))
+
+
+def page_count(path):
+    # A segment named e.g. page0001-0100.ndjson.gz holds 100 pages
+    match = re.fullmatch(r'page(\d+)-(\d+)\.ndjson\.gz', path.name)
+    if match is None:
+        return 1
+    return int(match.group(2)) - int(match.group(1)) + 1
+
+
+def read_results(path):
+    # Segments are read one line at a time, as they can be large
+    if path.name.endswith('.ndjson.gz'):
+        with open_page(path) as f:
+            for line in f:
+                yield json.loads(line)
+        return
+
+    with open_page(path) as f:
+        yield from json.load(f)['results']
+
+
+def read_deleted(metadata_dir):
+    # The ids of deleted sounds are listed one per line
+    # (see query_freesound.py)
+    path = metadata_dir / 'deleted.txt'
+    if not path.exists():
+        return set()
+    with open(path) as f:
+        return {int(line) for line in f if line.strip()}
+
+
+def open_page(path, mode='r'):
+    if path.name.endswith('.gz'):
+        return gzip.open(path, mode if 'b' in mode else mode + 't')
+    return open(path, mode)
+
+
+def _stat(path):
+    stat = path.stat()
+    return [stat.st_mtime_ns, stat.st_size]
+
+
+def _load_cache(cache_path):
+    if not cache_path.exists():
+        return None, {}
+
+    cache = pd.read_pickle(cache_path)
+    return cache['entries'], cache['pages']
+
+
+def _save_cache(cache_path, entries, stats):
+    # Write to a temporary file first so that the cache is never
+    # left in an inconsistent state
+    tmp_path = cache_path.with_name(cache_path.name + '.part')
+    pd.to_pickle({'entries': entries, 'pages': stats}, tmp_path)
+    os.replace(tmp_path, cache_path)
@@ -0,0 +1,58 @@
+import mmap
+import os
+import struct
+from collections import namedtuple
+
+
+class WavError(Exception):
+    pass
+
+
+class WavInfo(namedtuple('WavInfo', ['sample_rate', 'channels', 'bit_depth',
+                                     'n_frames', 'data_offset'])):
+    @property
+    def duration(self):
+        return self.n_frames / self.sample_rate
+
+
+def read_info(path):
+    # Memory-map the file so that only the pages containing the
+    # headers are read from disk
+    with open(path, 'rb') as f:
+        if os.fstat(f.fileno()).st_size < 12:
+            raise WavError('file is too short')
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as buf:
+            return parse_header(buf)
+
+
+def parse_header(buf):
+    riff, _, wave = struct.unpack_from('<4sI4s', buf, 0)
+    if riff != b'RIFF' or wave != b'WAVE':
+        raise WavError('not a RIFF/WAVE file')
+
+    # Iterate through the chunks until the data chunk is found
+    fmt = None
+    offset = 12
+    while offset + 8 <= len(buf):
+        chunk_id, chunk_size = struct.unpack_from('<4sI', buf, offset)
+        offset += 8
+
+        if chunk_id == b'fmt ':
+            if chunk_size < 16 or offset + 16 > len(buf):
+                raise WavError('invalid fmt chunk')
+            fmt = struct.unpack_from('<HHIIHH', buf, offset)
+        elif chunk_id == b'data':
+            if fmt is None:
+                raise WavError('data chunk precedes fmt chunk')
+            _, channels, sample_rate, _, block_align, bit_depth = fmt
+            if channels == 0 or sample_rate == 0 or block_align == 0:
+                raise WavError('invalid fmt chunk')
+            if offset + chunk_size > len(buf):
+                raise WavError('truncated data chunk')
+            n_frames = chunk_size // block_align
+            return WavInfo(sample_rate, channels, bit_depth, n_frames, offset)
+
+        # Chunks are aligned to two bytes
+        offset += chunk_size + (chunk_size & 1)
+
+    raise WavError('missing data chunk' if fmt else 'missing fmt chunk')